@@ -3,24 +3,36 @@ import io
 import json
 import logging
 import textwrap
+import time
 import traceback
 from contextlib import redirect_stdout
 
 import aiohttp
 import discord
-import websockets
 from discord.ext import commands
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from essentials.clusterstats import ShardLoad, health
+from essentials.db_indexes import ensure_indexes
+from essentials.deadlines import DeadlineScheduler
+from essentials.guildconfig import GuildConfigCache
+from essentials.invalidation import Invalidator
+from essentials.ipc_protocol import IPCClient
 from essentials.membercache import MemberCache
 from essentials.messagecache import MessageCache
-from essentials.multi_server import get_pre
+from essentials.multi_server import get_pre, load_prefixes
+from essentials.pollcache import PollCache
+from essentials.refreshscheduler import RefreshScheduler
 from essentials.settings import SETTINGS
+from essentials.userguilds import UserGuildIndex
+from essentials.votequeue import VoteWriter
+from essentials.voterstate import VoterStateCache
 
 class ClusterBot(commands.AutoShardedBot):
     def __init__(self, **kwargs):
         self.pipe = kwargs.pop('pipe')
         self.cluster_name = kwargs.pop('cluster_name')
+        cache_config = kwargs.pop('cache_config', None) or {}
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         intents = discord.Intents.all()
@@ -31,11 +43,14 @@ class ClusterBot(commands.AutoShardedBot):
         intents.guilds = True
         intents.presences = True
         super().__init__(**kwargs, loop=loop, intents=intents)
-        self.websocket = None
         self._last_result = None
-        self.ws_task = None
-        self.responses = asyncio.Queue()
-        self.eval_wait = False
+        self.shard_load = ShardLoad(self)
+        self.stats_task = None
+        self.heartbeat_task = None
+        self.ipc = IPCClient(self.cluster_name, f'ws://localhost:{SETTINGS.ipc_port}')
+        self.ipc.register('ping', self.ipc_ping)
+        self.ipc.register('eval', self.ipc_eval)
+        self.ipc_task = None
         log = logging.getLogger(f"Cluster#{self.cluster_name}")
         log.setLevel(logging.DEBUG)
         log.handlers = [logging.FileHandler(f'cluster-{self.cluster_name}.log', encoding='utf-8', mode='a')]
@@ -47,23 +62,43 @@ class ClusterBot(commands.AutoShardedBot):
         self.db = None
         self.session = None
         self.emoji_dict = None
-        self.pre = None
+        self.pre = {}
 
         self.remove_command('help')
-        self.load_extension("cogs.eval")
-        extensions = ['cogs.config', 'cogs.poll_controls', 'cogs.help', 'cogs.db_api', 'cogs.admin']
-        self.loop.create_task(self.ensure_ipc())
-        for ext in extensions:
-            self.load_extension(ext)
 
-        self.message_cache = MessageCache(self)
-        self.member_cache = MemberCache()
-        self.refresh_blocked = {}
-        self.refresh_queue = {}
+        self.message_cache = MessageCache(self,
+                                          maxsize=cache_config.get('message_cache_size'),
+                                          ttl=cache_config.get('message_cache_ttl'))
+        self.member_cache = MemberCache(maxsize=cache_config.get('member_cache_size'),
+                                        ttl=cache_config.get('member_cache_ttl'),
+                                        negative_ttl=cache_config.get('member_cache_negative_ttl'))
+        self.poll_cache = PollCache(maxsize=cache_config.get('poll_cache_size'),
+                                    ttl=cache_config.get('poll_cache_ttl'))
+        self.refresh_scheduler = RefreshScheduler(self)
+        self.deadlines = DeadlineScheduler(self)
+        self.vote_writer = VoteWriter(self)
+        self.voter_cache = VoterStateCache(self)
+        self.guild_config = GuildConfigCache(self)
+        self.user_guilds = UserGuildIndex(self,
+                                          maxsize=cache_config.get('user_guild_cache_size'),
+                                          ttl=cache_config.get('user_guild_cache_ttl'))
+        self.invalidator = Invalidator(self)
         
         self.run(kwargs['token'])
 
+    async def setup_hook(self):
+        # discord.py 2 loads extensions and starts tasks here, the event loop is not running in __init__
+        extensions = ['cogs.eval', 'cogs.config', 'cogs.poll_controls', 'cogs.help', 'cogs.db_api', 'cogs.admin']
+        for ext in extensions:
+            await self.load_extension(ext)
+        self.ipc_task = self.loop.create_task(self.ipc.run())
+        self.heartbeat_task = self.loop.create_task(self.heartbeat())
+        await self.invalidator.start()
+
     async def on_message(self, message):
+        self.shard_load.count(message.guild.id if message.guild else None)
+        if message.guild is not None and not message.author.bot:
+            self.user_guilds.add(message.author.id, message.guild.id)
         # allow case insensitive prefix
         prefix = await get_pre(self, message)
         if type(prefix) == tuple:
@@ -83,29 +118,72 @@ class ClusterBot(commands.AutoShardedBot):
         self.owner = await self.fetch_user(SETTINGS.owner_id)
         mongo = AsyncIOMotorClient(SETTINGS.mongo_db)
         self.db = mongo.pollmaster
+        await ensure_indexes(self.db)
         self.session = aiohttp.ClientSession()
         with open('utils/emoji-compact.json', encoding='utf-8') as emojson:
             self.emoji_dict = json.load(emojson)
-        self.pre = {entry['_id']: entry.get('prefix', 'pm!') async for entry in
-                   self.db.config.find({}, {'_id', 'prefix'})}
+        # only the guilds on the shards of this cluster
+        await load_prefixes(self, self.guilds)
         await self.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name="pm!help and /help"))
 
         self.log.info(f'[Cluster#{self.cluster_name}] Ready called.')
         self.pipe.send(1)
-        self.pipe.close()
+        if self.stats_task is None:
+            # the pipe stays open to report the load of this cluster to the launcher
+            self.stats_task = self.loop.create_task(self.report_stats())
+
+    async def report_stats(self):
+        while not self.is_closed():
+            await asyncio.sleep(SETTINGS.cluster_stats_interval)
+            try:
+                self.pipe.send({'stats': self.shard_load.snapshot()})
+            except (BrokenPipeError, OSError):
+                self.log.warning('Launcher pipe closed, no longer reporting stats')
+                return
+
+    async def heartbeat(self):
+        """Tell the launcher this process is alive, it restarts clusters that stop sending heartbeats"""
+        interval = SETTINGS.cluster_heartbeat_interval
+        while not self.is_closed():
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            # a sleep that took longer than asked for means the event loop was blocked
+            loop_lag = round((time.monotonic() - start - interval) * 1000)
+            try:
+                self.pipe.send({'heartbeat': health(self, loop_lag)})
+            except (BrokenPipeError, OSError):
+                self.log.warning('Launcher pipe closed, no longer sending heartbeats')
+                return
+
+    async def on_raw_reaction_add(self, data):
+        self.shard_load.count(data.guild_id)
+
+    async def on_raw_reaction_remove(self, data):
+        self.shard_load.count(data.guild_id)
 
     async def on_guild_join(self, server):
-        result = await self.db.config.find_one({'_id': str(server.id)})
-        if result is None:
-            await self.db.config.update_one(
-                {'_id': str(server.id)},
-                {'$set': {'prefix': 'pm!', 'admin_role': 'polladmin', 'user_role': 'polluser'}},
-                upsert=True
+        result = await self.guild_config.get(server.id)
+        if not result:
+            await self.guild_config.update(
+                server.id,
+                {'prefix': 'pm!', 'admin_role': 'polladmin', 'user_role': 'polluser'}
             )
             self.pre[str(server.id)] = 'pm!'
 
+    async def on_guild_remove(self, server):
+        self.guild_config.forget(server.id)
+
+    async def on_member_join(self, member):
+        self.user_guilds.add(member.id, member.guild.id)
+
+    async def on_member_remove(self, member):
+        self.user_guilds.discard(member.id, member.guild.id)
+
     async def on_shard_ready(self, shard_id):
         self.log.info(f'[Cluster#{self.cluster_name}] Shard {shard_id} ready')
+        if self.db is not None:
+            # a shard that reconnected later, the first ones are loaded in on_ready
+            await load_prefixes(self, [g for g in self.guilds if g.shard_id == shard_id])
 
     async def on_command_error(self, ctx, exc):
         if not isinstance(exc, (commands.CommandNotFound, commands.NotOwner)):
@@ -126,7 +204,7 @@ class ClusterBot(commands.AutoShardedBot):
 
     async def close(self, *args, **kwargs):
         self.log.info("shutting down")
-        await self.websocket.close()
+        await self.ipc.close()
         await super().close()
 
     async def exec(self, code):
@@ -153,7 +231,7 @@ class ClusterBot(commands.AutoShardedBot):
                 ret = await func()
         except Exception as e:
             value = stdout.getvalue()
-            f'{value}{traceback.format_exc()}'
+            return f'{value}{traceback.format_exc()}'
         else:
             value = stdout.getvalue()
 
@@ -166,47 +244,10 @@ class ClusterBot(commands.AutoShardedBot):
                 self._last_result = ret
                 return f'{value}{ret}'
 
-    async def websocket_loop(self):
-        while True:
-            try:
-                msg = await self.websocket.recv()
-            except websockets.ConnectionClosed as exc:
-                if exc.code == 1000:
-                    return
-                raise
-            data = json.loads(msg, encoding='utf-8')
-            if self.eval_wait and data.get('response'):
-                await self.responses.put(data)
-            cmd = data.get('command')
-            if not cmd:
-                continue
-            if cmd == 'ping':
-                ret = {'response': 'pong'}
-                self.log.info("received command [ping]")
-            elif cmd == 'eval':
-                self.log.info(f"received command [eval] ({data['content']})")
-                content = data['content']
-                data = await self.exec(content)
-                ret = {'response': str(data)}
-            else:
-                ret = {'response': 'unknown command'}
-            ret['author'] = self.cluster_name
-            self.log.info(f"responding: {ret}")
-            try:
-                await self.websocket.send(json.dumps(ret).encode('utf-8'))
-            except websockets.ConnectionClosed as exc:
-                if exc.code == 1000:
-                    return
-                raise
-
-    async def ensure_ipc(self):
-        self.websocket = w = await websockets.connect('ws://localhost:42069')
-        await w.send(self.cluster_name.encode('utf-8'))
-        try:
-            await w.recv()
-            self.ws_task = self.loop.create_task(self.websocket_loop())
-            self.log.info("ws connection succeeded")
-        except websockets.ConnectionClosed as exc:
-            self.log.warning(f"! couldnt connect to ws: {exc.code} {exc.reason}")
-            self.websocket = None
-            raise
+    async def ipc_ping(self, data):
+        self.log.info("received command [ping]")
+        return 'pong'
+
+    async def ipc_eval(self, data):
+        self.log.info(f"received command [eval] ({data['content']})")
+        return str(await self.exec(data['content']))
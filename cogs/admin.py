@@ -1,9 +1,15 @@
+import asyncio
+import datetime
 import logging
 
 import discord
 from discord.ext import commands
 from discord import app_commands
 
+from essentials.clusterstats import health
+from essentials.db_indexes import audit_query_plans
+from essentials.ipc_protocol import IPCError, LAUNCHER
+
 class Admin(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -60,6 +66,80 @@ class Admin(commands.Cog):
         finally:
             logger.info(reply)
             await ctx.reply(reply, delete_after=60)
+
+    @commands.hybrid_command(description="Shows cache sizes and hit rates (bot owner only)")
+    async def cachestats(self, ctx):
+        caches = {
+            'messages': self.bot.message_cache.stats(),
+            'members': self.bot.member_cache.stats(),
+            'voters': self.bot.voter_cache.stats(),
+            'guild configs': self.bot.guild_config.stats(),
+            'user guilds': self.bot.user_guilds.stats()
+        }
+        caches.update(self.bot.poll_cache.stats())
+        lines = []
+        for name, st in caches.items():
+            lines.append(f'**{name}**: {st["size"]}/{st["maxsize"]} entries, '
+                         f'{st["hit_rate"]:.1%} hit rate ({st["hits"]} hits, {st["misses"]} misses), '
+                         f'{st["evictions"]} evicted, {st["expirations"]} expired')
+        await ctx.reply('\n'.join(lines), delete_after=120)
+
+    @commands.hybrid_command(description="Shows the health of all clusters (bot owner only)")
+    async def status(self, ctx):
+        await ctx.defer()
+        if getattr(self.bot, 'ipc', None) is None:
+            # single process, no launcher
+            clusters = {'pollmaster': dict(health(self.bot), state='ready' if self.bot.is_ready() else 'starting')}
+        else:
+            try:
+                clusters = await self.bot.ipc.request(LAUNCHER, 'status', timeout=5)
+            except (IPCError, asyncio.TimeoutError) as e:
+                return await ctx.reply(f'Could not reach the launcher: {e}')
+
+        lines = []
+        for name, st in clusters.items():
+            latencies = [l for l in (st.get('latencies') or {}).values() if l is not None]
+            line = f'**{name}** {st["state"]}'
+            if st.get('pid'):
+                line += f', pid {st["pid"]}'
+            if st.get('uptime') is not None:
+                line += f', up {datetime.timedelta(seconds=int(st["uptime"]))}'
+            if st.get('crashes'):
+                line += f', {st["crashes"]} crashes'
+            if st.get('heartbeat_age') is not None:
+                line += f', heartbeat {st["heartbeat_age"]:.0f}s ago'
+            if st.get('loop_lag') is not None:
+                line += f', loop lag {st["loop_lag"]}ms'
+            if latencies:
+                line += f', latency {sum(latencies) / len(latencies):.0f}ms avg / {max(latencies)}ms max'
+            if len(latencies) < len(st.get('latencies') or {}):
+                line += f' ({len(st["latencies"]) - len(latencies)} shards down)'
+            if st.get('memory'):
+                line += f', {st["memory"] / 2 ** 20:.0f} MB'
+            if st.get('guilds') is not None:
+                line += f', {st["guilds"]} guilds'
+            lines.append(line)
+        if not lines:
+            return await ctx.reply('No clusters.')
+        # stay below the message length limit
+        chunk = ''
+        for line in lines:
+            if len(chunk) + len(line) > 1900:
+                await ctx.reply(chunk)
+                chunk = ''
+            chunk += line + '\n'
+        await ctx.reply(chunk)
+
+    @commands.hybrid_command(description="Explains the database queries and flags collection scans (bot owner only)")
+    async def dbaudit(self, ctx):
+        await ctx.defer()
+        results = await audit_query_plans(self.bot.db)
+        lines = []
+        for name, stages, collscan in results:
+            lines.append(f'{":warning:" if collscan else ":white_check_mark:"} **{name}**: {" > ".join(stages)}')
+            if collscan:
+                logger.warning(f'Query "{name}" uses a collection scan: {stages}')
+        await ctx.reply('\n'.join(lines))
             
     id = str
     @app_commands.command(name="guildleave", description="leaves a specified guild (bot owner only)")
@@ -68,7 +148,7 @@ class Admin(commands.Cog):
     )
     async def guildleave(self, ctx, *, id: id = None):
         await ctx.response.defer(thinking=True)
-        result = await self.bot.db.config.find_one({'_id': id})
+        result = await self.bot.guild_config.get(id)
         if not isinstance(ctx.channel, discord.TextChannel):
             await ctx.followup.send("`/guildleave` can only be used in a server text channel.")
             return
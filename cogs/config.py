@@ -50,7 +50,7 @@ class Config(commands.Cog):
         #    msg = f'The server prefix has been set to `{pre}` Use `{pre}prefix <prefix>` to change it again. ' \
         #          f'If you would like to add a trailing whitespace to the prefix, use `{pre}prefix {pre}\w`.'
 
-        #await self.bot.db.config.update_one({'_id': str(server.id)}, {'$set': {'prefix': str(pre)}}, upsert=True)
+        #await self.bot.guild_config.update(server.id, {'prefix': str(pre)})
         #self.bot.pre[str(server.id)] = str(pre)
         msg = f'This command is **disabled** as of 4/24/2024 EST\nJoin the support server for more info or if you have any questions.'
         await ctx.send(msg)
@@ -66,7 +66,7 @@ class Config(commands.Cog):
         await ctx.response.defer(thinking=True)
         
         if not role:
-            result = await self.bot.db.config.find_one({'_id': str(server.id)})
+            result = await self.bot.guild_config.get(server.id)
             if result and result.get('admin_role'):
                 await ctx.followup.send(f'The admin role restricts which users are able to create and manage ALL polls on this server. \n'
                                    f'The current admin role is `{result.get("admin_role")}`. '
@@ -76,7 +76,7 @@ class Config(commands.Cog):
                                    f'No admin role set. '
                                    f'To set one type `{result.get("prefix")}adminrole <role name>`')
         elif role.name in [r.name for r in server.roles]:
-            await self.bot.db.config.update_one({'_id': str(server.id)}, {'$set': {'admin_role': str(role)}}, upsert=True)
+            await self.bot.guild_config.update(server.id, {'admin_role': str(role)})
             await ctx.followup.send(f'Server role `{role}` can now manage all polls.')
         else:
             await ctx.followup.send(f'Server role `{role}` not found.')
@@ -92,7 +92,7 @@ class Config(commands.Cog):
         await ctx.response.defer(thinking=True)
 
         if not role:
-            result = await self.bot.db.config.find_one({'_id': str(server.id)})
+            result = await self.bot.guild_config.get(server.id)
             if result and result.get('user_role'):
                 await ctx.followup.send(f'The user role restricts which users are able to create and manage their own polls.  \n'
                                    f'The current user role is `{result.get("user_role")}`. '
@@ -102,7 +102,7 @@ class Config(commands.Cog):
                                    f'No user role set. '
                                    f'To set one type `{result.get("prefix")}userrole <role name>`')
         elif role.name in [r.name for r in server.roles]:
-            await self.bot.db.config.update_one({'_id': str(server.id)}, {'$set': {'user_role': str(role)}}, upsert=True)
+            await self.bot.guild_config.update(server.id, {'user_role': str(role)})
             await ctx.followup.send(f'Server role `{role}` can now create and manage their own polls.')
         else:
             await ctx.followup.send(f'Server role `{role}` not found.')
@@ -117,24 +117,24 @@ class Config(commands.Cog):
     )
     async def settings(self, ctx, *, change: discord.app_commands.Choice[int]):
         server = ctx.guild
-        result = await self.bot.db.config.find_one({'_id': str(server.id)},{'_id': 1, 'error_mess': 2, 'closedpoll_mess': 3 })
+        result = await self.bot.guild_config.get(server.id)
         await ctx.response.defer(thinking=True)
         print('settings message ran!')
         if change.name == "pollclosed message": #pollclosed message
             if result and not result.get('closedpoll_mess'):
                 print('closed poll config not found!', result.get('closedpoll_mess'))
-                await self.bot.db.config.update_one({'_id': str(server.id)}, {'$set': {'closedpoll_mess': 'True'}}, upsert=True)
+                await self.bot.guild_config.update(server.id, {'closedpoll_mess': 'True'})
                 await ctx.followup.send("closed poll message was set to `enable`!!")
                 
             elif result and result.get('closedpoll_mess'):
                 print('closed poll resultget!', result.get('closedpoll_mess'))
                 if result.get('closedpoll_mess') == 'True':
-                    await self.bot.db.config.update_one({'_id': str(server.id)}, {'$set': {'closedpoll_mess': 'False'}}, upsert=True)
+                    await self.bot.guild_config.update(server.id, {'closedpoll_mess': 'False'})
                     await ctx.followup.send("closed poll message was set to `disabled`!!")
                     print('closed poll result true')
                     
                 elif result and result.get('closedpoll_mess') == 'False':
-                    await self.bot.db.config.update_one({'_id': str(server.id)}, {'$set': {'closedpoll_mess': 'True'}}, upsert=True)
+                    await self.bot.guild_config.update(server.id, {'closedpoll_mess': 'True'})
                     await ctx.followup.send("closed poll message was set to `enable`!!")
                     print('closed poll result false')
                 else:
@@ -144,18 +144,18 @@ class Config(commands.Cog):
         elif change.name == "errormessage": #errormessage
             if result and not result.get('error_mess'):
                 print('error config not found!', result.get('error_mess'))
-                await self.bot.db.config.update_one({'_id': str(server.id)}, {'$set': {'error_mess': 'True'}}, upsert=True)
+                await self.bot.guild_config.update(server.id, {'error_mess': 'True'})
                 await ctx.followup.send("error messages was set to `enable`!!")
                 
             elif result and result.get('error_mess'):
                 print('error resultget!', result.get('error_mess'))
                 if result.get('error_mess') == 'True':
-                    await self.bot.db.config.update_one({'_id': str(server.id)}, {'$set': {'error_mess': 'False'}}, upsert=True)
+                    await self.bot.guild_config.update(server.id, {'error_mess': 'False'})
                     await ctx.followup.send("error messages was set to `disabled`!!")
                     print('error result true')
                     
                 elif result and result.get('error_mess') == 'False':
-                    await self.bot.db.config.update_one({'_id': str(server.id)}, {'$set': {'error_mess': 'True'}}, upsert=True)
+                    await self.bot.guild_config.update(server.id, {'error_mess': 'True'})
                     await ctx.followup.send("error messages was set to `enable`!!")
                     print('error result false')
                 else:
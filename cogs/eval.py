@@ -1,6 +1,4 @@
-import asyncio
 import io
-import json
 import textwrap
 import traceback
 from contextlib import redirect_stdout
@@ -16,19 +14,11 @@ class Eval(commands.Cog):
     @commands.hybrid_command(name="eval", description="""Evaluates a code""")
     @commands.is_owner()
     async def evall(self, ctx, *, body: str):
-        self.bot.eval_wait = True
-        try:
-            await self.bot.websocket.send(json.dumps({'command': 'eval', 'content': body}).encode('utf-8'))
-            msgs = []
-            while True:
-                try:
-                    msg = await asyncio.wait_for(self.bot.responses.get(), timeout=3)
-                except asyncio.TimeoutError:
-                    break
-                msgs.append(f'{msg["author"]}: {msg["response"]}')
-            await ctx.send(' '.join(f'```py\n{m}\n```' for m in msgs))
-        finally:
-            self.bot.eval_wait = False
+        if getattr(self.bot, 'ipc', None) is None:
+            return await ctx.send('Evaluating on all clusters is only available when running with the launcher.')
+        answers = await self.bot.ipc.ask_all('eval', {'content': body}, timeout=3)
+        msgs = [f'{name}: {answer}' for name, answer in sorted(answers.items())]
+        await ctx.send(' '.join(f'```py\n{m}\n```' for m in msgs) or 'No cluster answered.')
 
     @commands.hybrid_command(hidden=True, name='eval', description="""Evaluates a code""")
     @commands.is_owner()
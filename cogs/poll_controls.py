@@ -4,7 +4,7 @@ import datetime
 import logging
 import random
 import shlex
-import time
+from functools import partial
 from string import ascii_lowercase
 import regex
 
@@ -15,9 +15,11 @@ from bson import ObjectId
 from discord.ext import tasks, commands
 
 from discord import app_commands
+from essentials.deadlines import DeadlineScheduler
 from essentials.exceptions import StopWizard
 from essentials.multi_server import get_server_pre, ask_for_server, ask_for_channel
 from essentials.settings import SETTINGS
+from essentials.workpool import KeyedWorkerPool, RouteLimiter
 from models.poll import Poll
 from utils.misc import CustomFormatter
 from utils.paginator import embed_list_paginated
@@ -33,142 +35,134 @@ class PollControls(commands.Cog):
         self.bot = bot
         self.ignore_next_removed_reaction = {}
         self.index = 0
+        # due polls are processed in parallel, but only one at a time per channel
+        self.deadline_pool = KeyedWorkerPool(SETTINGS.deadline_workers)
+        # every request of an announcement (message, embed and each reaction) is charged to its channel's route
+        self.deadline_limiter = RouteLimiter(
+            {'message': SETTINGS.deadline_channel_messages, 'reaction': SETTINGS.deadline_channel_reactions},
+            SETTINGS.deadline_global_requests
+        )
+        self.bot.deadlines.handler = self.on_deadline
+        self.bot.deadlines.start()
         self.close_activate_polls.add_exception_type(KeyError)
         self.close_activate_polls.start()
         self.refresh_queue.start()
 
     def cog_unload(self):
+        self.bot.deadlines.stop()
         self.close_activate_polls.cancel()
         self.refresh_queue.cancel()
 
     # noinspection PyCallingNonCallable
-    @tasks.loop(seconds=30)
+    @tasks.loop(minutes=10)
     async def close_activate_polls(self):
+        # deadlines are fired by bot.deadlines, this pass only picks up polls it does not know about yet
         if hasattr(self.bot, 'db') and hasattr(self.bot.db, 'polls'):
-            utc_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
-
-            # auto-close polls
-            query = self.bot.db.polls.find({'open': True, 'duration': {
-                '$gte': utc_now - datetime.timedelta(weeks=8),
-                '$lte': utc_now + datetime.timedelta(minutes=1)
-            }})
-            if query:
-                for limit, pd in enumerate([poll async for poll in query]):
-                    if limit >= 30:
-                        print("More than 30 polls due to be closed! Throttling to 30 per 30 sec.")
-                        logger.warning("More than 30 polls due to be closed! Throttling to 30 per 30 sec.")
-                        break
-
-                    # load poll (this will close the poll if necessary and update the DB)
-                    p = Poll(self.bot, load=True)
-                    if not p:
-                        continue
-                    await p.from_dict(pd)
-
-                    # Check if Pollmaster is still present on the server
-                    if not p.server:
-                        # Bot is not present on that server. Close poll directly in the DB.
-                        await self.bot.db.polls.update_one({'_id': p.id}, {'$set': {'open': False}})
-                        logger.info(f"Closed poll on a server ({pd['server_id']}) without Pollmaster being present.")
-                        continue
-                    # Check if poll was closed and inform the sever if the poll is less than 2 hours past due
-                    # (Closing old polls should only happen if the bot was offline for an extended period)
-                    if not p.open:
-                        if p.duration.replace(tzinfo=pytz.utc) >= utc_now - datetime.timedelta(hours=2):
-                            # only send messages for polls that were supposed to expire in the past 2 hours
-                            try:
-                                guild_config = await self.bot.db.config.find_one({'_id': str(p.server.id)},{'_id': 1, 'error_mess': 2, 'closedpoll_mess': 3 })
-                                if guild_config and not guild_config.get('closedpoll_mess') or guild_config and guild_config.get('closedpoll_mess') == 'True':
-                                    await p.channel.send('This poll has reached the deadline and is closed!')
-                                    await p.post_embed(p.channel)
-                                else:
-                                    print('will not send message for closed poll!!', guild_config)
-                                #await p.channel.send('This poll has reached the deadline and is closed!')
-                                #await p.post_embed(p.channel)
-                            except:
-                                logger.warning(f"Failed to send message for a closed poll: {p.server.id}")
-                                # send bot owner a DM
-                                warningdm = await self.bot.fetch_user(self.bot.owner)
-                                e = discord.Embed(
-                                    title=f"Error With: Failed to send message for a closed poll",
-                                    description=f"```py\n{type(self).__name__}: {traceback.format_exc(limit=0)}\n```\n\nContent: {p.short}"
-                                                f"\n\tServer: {p.server}\n\tServerid: {p.server.id}\n\tChannel: #{f'{p.channel.id}' if p.channel is not None else 'None'}",
-                                    timestamp=None
-                                )
-                                await warningdm.send(embed=e)
-                        else:
-                            logger.info(f"Closing old poll: {p.id}")
-
-            # auto-activate polls
-            query = self.bot.db.polls.find({'active': False, 'activation': {
-                '$gte': utc_now - datetime.timedelta(weeks=8),
-                '$lte': utc_now + datetime.timedelta(minutes=1)
-            }})
-            if query:
-                for limit, pd in enumerate([poll async for poll in query]):
-                    if limit >= 10:
-                        print("More than 10 polls due to be closed! Throttling to 10 per 30 sec.")
-                        logger.warning("More than 10 polls due to be closed! Throttling to 10 per 30 sec.")
-                        break
-
-                    # load poll (this will activate the poll if necessary and update the DB)
-                    p = Poll(self.bot, load=True)
-                    await p.from_dict(pd)
-
-                    # Check if Pollmaster is still present on the server
-                    if not p.server:
-                        # Bot is not present on that server. Close poll directly in the DB.
-                        await self.bot.db.polls.update_one({'_id': p.id}, {'$set': {'active': True}})
-                        logger.info(f"Activated poll on a server ({pd['server_id']}) without Pollmaster being present.")
-                        continue
-                    # Check if poll was activated and inform the sever if the poll is less than 2 hours past due
-                    # (activating old polls should only happen if the bot was offline for an extended period)
-                    if p.active:
-                        if p.activation.replace(tzinfo=pytz.utc) >= utc_now - datetime.timedelta(hours=2):
-                            # only send messages for polls that were supposed to expire in the past 2 hours
-                            try:
-                                await p.channel.send('This poll has been scheduled and is active now!')
-                                await p.post_embed(p.channel)
-                            except:
-                                logger.warning(f"Failed to send message for a active poll: {p.server.id}")
-                                # send bot owner a DM
-                                warningdm = await self.bot.fetch_user(self.bot.owner)
-                                e = discord.Embed(
-                                    title=f"Error With: Failed to send message for a active poll",
-                                    description=f"```py\n{type(self).__name__}: {traceback.format_exc(limit=0)}\n```\n\nContent: {p.short}"
-                                                f"\n\tServer: {p.server}\n\tServerid: {p.server.id}\n\tChannel: #{p.channel.id}",
-                                    timestamp=None
-                                )
-                                await warningdm.send(embed=e)
-                        else:
-                            logger.info(f"Activating old poll: {p.id}")
+            await self.bot.deadlines.load()
         else:
             print('unknown error for close_activate_polls')
             logger.info(f"unknown error for close_activate_polls")
 
+    async def on_deadline(self, kind, poll_id):
+        pd = await self.bot.db.polls.find_one({'_id': ObjectId(poll_id)})
+        if pd is None:
+            return
+        utc_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        if kind == DeadlineScheduler.CLOSE and pd.get('open'):
+            await self.deadline_pool.run(pd.get('channel_id'), self.close_due_poll, pd, utc_now)
+        elif kind == DeadlineScheduler.ACTIVATE and not pd.get('active'):
+            await self.deadline_pool.run(pd.get('channel_id'), self.activate_due_poll, pd, utc_now)
+
+    async def close_due_poll(self, pd, utc_now):
+        # load poll (this will close the poll if necessary and update the DB)
+        p = Poll(self.bot, load=True)
+        if not p:
+            return
+        await p.from_dict(pd)
+
+        # Check if Pollmaster is still present on the server
+        if not p.server:
+            # Bot is not present on that server. Close poll directly in the DB.
+            await self.bot.db.polls.update_one({'_id': p.id}, {'$set': {'open': False}, '$inc': {'version': 1}})
+            self.bot.poll_cache.invalidate(pd['server_id'], pd['short'])
+            self.bot.invalidator.poll(pd['server_id'], pd['short'], pd['_id'])
+            logger.info(f"Closed poll on a server ({pd['server_id']}) without Pollmaster being present.")
+            return
+        # Check if poll was closed and inform the sever if the poll is less than 2 hours past due
+        # (Closing old polls should only happen if the bot was offline for an extended period)
+        if not p.open:
+            if p.duration.replace(tzinfo=pytz.utc) >= utc_now - datetime.timedelta(hours=2):
+                # only send messages for polls that were supposed to expire in the past 2 hours
+                try:
+                    guild_config = await self.bot.guild_config.get(p.server.id)
+                    if guild_config.closed_poll_messages:
+                        throttle = partial(self.deadline_limiter.acquire, p.channel.id)
+                        await throttle('message')
+                        await p.channel.send('This poll has reached the deadline and is closed!')
+                        await p.post_embed(p.channel, throttle)
+                    else:
+                        print('will not send message for closed poll!!', guild_config.document)
+                    #await p.channel.send('This poll has reached the deadline and is closed!')
+                    #await p.post_embed(p.channel)
+                except:
+                    logger.warning(f"Failed to send message for a closed poll: {p.server.id}")
+                    # send bot owner a DM
+                    warningdm = await self.bot.fetch_user(self.bot.owner)
+                    e = discord.Embed(
+                        title=f"Error With: Failed to send message for a closed poll",
+                        description=f"```py\n{type(self).__name__}: {traceback.format_exc(limit=0)}\n```\n\nContent: {p.short}"
+                                    f"\n\tServer: {p.server}\n\tServerid: {p.server.id}\n\tChannel: #{f'{p.channel.id}' if p.channel is not None else 'None'}",
+                        timestamp=None
+                    )
+                    await warningdm.send(embed=e)
+            else:
+                logger.info(f"Closing old poll: {p.id}")
+
+    async def activate_due_poll(self, pd, utc_now):
+        # load poll (this will activate the poll if necessary and update the DB)
+        p = Poll(self.bot, load=True)
+        await p.from_dict(pd)
+
+        # Check if Pollmaster is still present on the server
+        if not p.server:
+            # Bot is not present on that server. Close poll directly in the DB.
+            await self.bot.db.polls.update_one({'_id': p.id}, {'$set': {'active': True}, '$inc': {'version': 1}})
+            self.bot.poll_cache.invalidate(pd['server_id'], pd['short'])
+            self.bot.invalidator.poll(pd['server_id'], pd['short'], pd['_id'])
+            logger.info(f"Activated poll on a server ({pd['server_id']}) without Pollmaster being present.")
+            return
+        # Check if poll was activated and inform the sever if the poll is less than 2 hours past due
+        # (activating old polls should only happen if the bot was offline for an extended period)
+        if p.active:
+            if p.activation.replace(tzinfo=pytz.utc) >= utc_now - datetime.timedelta(hours=2):
+                # only send messages for polls that were supposed to expire in the past 2 hours
+                try:
+                    throttle = partial(self.deadline_limiter.acquire, p.channel.id)
+                    await throttle('message')
+                    await p.channel.send('This poll has been scheduled and is active now!')
+                    await p.post_embed(p.channel, throttle)
+                except:
+                    logger.warning(f"Failed to send message for a active poll: {p.server.id}")
+                    # send bot owner a DM
+                    warningdm = await self.bot.fetch_user(self.bot.owner)
+                    e = discord.Embed(
+                        title=f"Error With: Failed to send message for a active poll",
+                        description=f"```py\n{type(self).__name__}: {traceback.format_exc(limit=0)}\n```\n\nContent: {p.short}"
+                                    f"\n\tServer: {p.server}\n\tServerid: {p.server.id}\n\tChannel: #{p.channel.id}",
+                        timestamp=None
+                    )
+                    await warningdm.send(embed=e)
+            else:
+                logger.info(f"Activating old poll: {p.id}")
+
     @close_activate_polls.before_loop
     async def before_close_activate_polls(self):
         # print('close task waiting...')
         await self.bot.wait_until_ready()
 
-    @tasks.loop(seconds=5)
+    @tasks.loop(seconds=1)
     async def refresh_queue(self):
-        remove_list = []
-        for pid, t in self.bot.refresh_blocked.items():
-            if t - time.time() < 0:
-                remove_list.append(pid)
-                if self.bot.refresh_queue.get(pid, False):
-                    query = await self.bot.db.polls.find_one({'_id': ObjectId(pid)})
-                    if query:
-                        p = Poll(self.bot, load=True)
-                        if p:
-                            await p.from_dict(query)
-                            await p.refresh(self.bot.refresh_queue.get(pid))
-                            del self.bot.refresh_queue[pid]
-
-        # don't change dict while iterating
-        for pid in remove_list:
-            del self.bot.refresh_blocked[pid]
+        await self.bot.refresh_scheduler.flush()
 
     @refresh_queue.before_loop
     async def before_refresh_queue(self):
@@ -188,6 +182,38 @@ class PollControls(commands.Cog):
                     label = label_full[3:]
         return label
 
+    async def get_poll_message(self, channel, message_id):
+        """Find the poll label for a reaction in a server channel.
+        The message index is tried first, so the message only needs to be fetched for polls that were posted
+        before the index existed. Returns (label, message), message may be a discord.PartialMessage."""
+        key = await Poll.resolve_message(self.bot, message_id)
+        if key is False:
+            return None, None
+        message = self.bot.message_cache.get(message_id)
+        if key is not None:
+            if key[0] != str(channel.guild.id):
+                return None, None
+            if message is None:
+                message = channel.get_partial_message(message_id)
+            return key[1], message
+
+        if message is None:
+            try:
+                message = await channel.fetch_message(message_id)
+            except discord.errors.Forbidden:
+                # Ignore Missing Access error
+                return None, None
+            self.bot.message_cache.put(message_id, message)
+        if message.author.id != self.bot.user.id:
+            self.bot.poll_cache.mark_not_poll(message_id)
+            return None, None
+        label = self.get_label(message)
+        if not label:
+            self.bot.poll_cache.mark_not_poll(message_id)
+            return None, None
+        await Poll.link_message(self.bot, message, channel.guild.id, label)
+        return label, message
+
     async def is_admin_or_creator(self, ctx, server, owner_id, error_msg=None):
         member = ctx.user
         # member = server.get_member(ctx.message.author.id)
@@ -196,7 +222,7 @@ class PollControls(commands.Cog):
         elif member.guild_permissions.manage_guild:
             return True
         else:
-            result = await self.bot.db.config.find_one({'_id': str(server.id)})
+            result = await self.bot.guild_config.get(server.id)
             if result and result.get('admin_role') in [r.name for r in member.roles]:
                 return True
             else:
@@ -323,24 +349,21 @@ class PollControls(commands.Cog):
                 ):
                     return False
 
-                # Delete Poll and delete vote
-                resultv2 = None
-                resultv2 = await self.bot.db.polls.find_one({"server_id": str(server.id), 'short': short},{ "_id": 1, "server_id": 2, "short": 3 })
-                result_vote = self.bot.db.votes.find({"poll_id": ObjectId(str(resultv2['_id']))},{ "poll_id": 1, "user_id": 2})
-                if resultv2 is not None:
-                    result_list_vote = [poll async for poll in result_vote.sort('poll_id', -1)]
-                print('delete vote', result_list_vote, 'server_id:', server.id, 'short:', short)
-                logger.info(f'deleted votes for poll ({short}). server_id: {server.id}, raw: {result_list_vote}')
-                for i in range(len(result_list_vote)):
-                    result_vote_delete = await self.bot.db.votes.delete_one({"poll_id": result_list_vote[i]['poll_id']})
-                    if result_vote_delete.deleted_count == 1:
-                        pass
+                # Delete the poll with its votes, large polls report their progress
+                progress_message = None
+
+                async def progress(deleted, total):
+                    nonlocal progress_message
+                    text = f'Deleting votes of poll "{short}": {deleted}/{total}'
+                    if progress_message is None:
+                        progress_message = await ctx.followup.send(text, wait=True)
                     else:
-                        print('poll vote deleted failed!')
-                        logger.error(f'poll vote deleted failed!: {resultv2}, server_id: {server.id}')
-                
-                result = await self.bot.db.polls.delete_one({'server_id': str(server.id), 'short': short})
-                if result.deleted_count == 1:
+                        await progress_message.edit(content=text)
+
+                deleted = await p.delete_from_db(progress=progress)
+                if progress_message is not None:
+                    await progress_message.delete()
+                if deleted:
                     say = f'Poll with label "{short}" was successfully deleted. This action can\'t be undone!'
                     title = 'Poll deleted'
                     await self.say_embed(ctx, say, title)
@@ -453,8 +476,12 @@ class PollControls(commands.Cog):
     @app_commands.command(name="export", description="Export a poll.")
     @app_commands.describe(
         short='Choose name of poll to export',
+        format='Readable report (default) or the raw vote table as CSV, JSON lines or a compact columnar file',
+    )
+    @app_commands.choices(
+        format=[discord.app_commands.Choice(name='report (txt)', value='txt'), discord.app_commands.Choice(name='csv', value='csv'), discord.app_commands.Choice(name='json lines', value='jsonl'), discord.app_commands.Choice(name='columnar', value='columnar')],
     )
-    async def export(self, ctx, *, short: str=None):
+    async def export(self, ctx, *, short: str=None, format: discord.app_commands.Choice[str]=None):
         server = await ask_for_server(self.bot, ctx, short)
         if not server:
             return
@@ -490,7 +517,7 @@ class PollControls(commands.Cog):
                 else:
                     # sending file
                     await ctx.followup.send(f'Sending you the requested export of "{short}". check your DM')
-                    file_name = await p.export()
+                    file_name = await p.export(format.value if format else 'txt')
                     if file_name is not None:
                         await ctx.user.send('Sending you the requested export of "{}".'.format(p.short),
                                                       file=discord.File(file_name)
@@ -1221,7 +1248,7 @@ class PollControls(commands.Cog):
         # member = server.get_member(ctx.message.author.id)
         member = ctx.user
         if not member.guild_permissions.manage_guild:
-            result = await self.bot.db.config.find_one({'_id': str(server.id)})
+            result = await self.bot.guild_config.get(server.id)
             if result and result.get('admin_role') not in [r.name for r in member.roles] and result.get(
                     'user_role') not in [r.name for r in member.roles]:
                 print("a wizard was canceled. user had no permission!")
@@ -1232,7 +1259,7 @@ class PollControls(commands.Cog):
                                                 f'`{pre}adminrole`~~ or `/userrole` and `/adminrole`')
                     return
                 except discord.Forbidden:
-                    if result and not result.get('error_mess') or result and result.get('error_mess') == 'True':
+                    if result.error_messages:
                         errormessage = traceback.format_exc(limit=0)
                         embederror = discord.Embed(title='Poll Command Error', color=discord.Color.red())
                         if errormessage.find("Cannot send messages to this user") >= 0:
@@ -1287,46 +1314,14 @@ class PollControls(commands.Cog):
         channel_id = data.channel_id
         channel = self.bot.get_channel(channel_id)
         #print('channel type remove', type(channel))
-        if isinstance(channel, discord.TextChannel):
+        if isinstance(channel, (discord.TextChannel, discord.Thread)):
             server = channel.guild
-            # user = server.get_member(user_id)
-            # user = await self.bot.fetch_user(user_id)
-            user = await self.bot.member_cache.get(server, user_id)
-            message = self.bot.message_cache.get(message_id)
-            #print('reactionremove textchannel ran!message', message, 'm_id', message_id)
-            if message is None:
-                try:
-                    message = await channel.fetch_message(message_id)
-                except discord.errors.Forbidden:
-                    # Ignore Missing Access error
-                    return
-                self.bot.message_cache.put(message_id, message)
-            if message.author.id != self.bot.user.id:
-                #print("ignore message remove", message_id)
-                return
-            label = self.get_label(message)
+            label, message = await self.get_poll_message(channel, message_id)
             if not label:
                 return
-        elif isinstance(channel, discord.Thread):
-            server = channel.guild
             # user = server.get_member(user_id)
             # user = await self.bot.fetch_user(user_id)
             user = await self.bot.member_cache.get(server, user_id)
-            message = self.bot.message_cache.get(message_id)
-            #print('reactionremove Thread ran!message', message, 'm_id', message_id)
-            if message is None:
-                try:
-                    message = await channel.fetch_message(message_id)
-                except discord.errors.Forbidden:
-                    # Ignore Missing Access error
-                    return
-                self.bot.message_cache.put(message_id, message)
-            if message.author.id != self.bot.user.id:
-                #print("ignore message remove", message_id)
-                return
-            label = self.get_label(message)
-            if not label:
-                return
         elif isinstance(channel, discord.DMChannel):
             user = await self.bot.fetch_user(user_id)  # only do this once
             message = self.bot.message_cache.get(message_id)
@@ -1336,7 +1331,7 @@ class PollControls(commands.Cog):
             label = self.get_label(message)
             if not label:
                 return
-            server = await ask_for_server(self.bot, message, label)
+            server = await ask_for_server(self.bot, message, label, user)
 
         elif not channel:
             # discord rapidly closes dm channels by desing
@@ -1351,9 +1346,12 @@ class PollControls(commands.Cog):
             label = self.get_label(message)
             if not label:
                 return
-            server = await ask_for_server(self.bot, message, label)
+            server = await ask_for_server(self.bot, message, label, user)
         else:
             return
+        if server is None:
+            # no shared server with this poll was found for the user
+            return
 
         p = await Poll.load_from_db(self.bot, server.id, label)
         if not isinstance(p, Poll):
@@ -1381,53 +1379,12 @@ class PollControls(commands.Cog):
         channel_id = data.channel_id
         channel = self.bot.get_channel(channel_id)
         #print('reaction_add data!channel', type(channel))
-        if isinstance(channel, discord.TextChannel):
-            #print('reactiontextchannel ran!')
-            server = channel.guild
-            #print('reactiontextchannel ran!server', server)
-            # user = server.get_member(user_id)
-            #print('reaction textchannel ran!', 'm_id', message_id)
-            message = self.bot.message_cache.get(message_id)
-            #print('reaction textchannel ran!message', message, 'm_id', message_id)
-            #messagev2 = await channel.fetch_message(message_id)
-            #labelv2 = self.get_label(messagev2)
-            #print('reactiontextchannel ran!labelv2', labelv2)
-            #print('reactiontextchannel ran!message', message)
-            if message is None:
-                #print('yes message is None!!')
-                try:
-                    message = await channel.fetch_message(message_id)
-                except discord.errors.Forbidden:
-                    # Ignore Missing Access error
-                    return
-                self.bot.message_cache.put(message_id, message)
-            if message.author.id != self.bot.user.id:
-                #print("ignore message", message_id)
-                return
-            label = self.get_label(message)
-            #print('reactiontextchannel ran!label', label)
-            if not label:
-                return
-        elif isinstance(channel, discord.Thread):
-            #print('reactionThreadchannel ran!')
+        if isinstance(channel, (discord.TextChannel, discord.Thread)):
             server = channel.guild
-            # user = server.get_member(user_id)
-            message = self.bot.message_cache.get(message_id)
-            if message is None:
-                #print('yes message is None!!')
-                try:
-                    message = await channel.fetch_message(message_id)
-                except discord.errors.Forbidden:
-                    # Ignore Missing Access error
-                    return
-                self.bot.message_cache.put(message_id, message)
-            if message.author.id != self.bot.user.id:
-                #print("ignore message", message_id)
-                return
-            label = self.get_label(message)
-            #print('reactionThreadchannel ran!label', label)
+            label, message = await self.get_poll_message(channel, message_id)
             if not label:
                 return
+            self.bot.user_guilds.add(user_id, server.id)
         elif isinstance(channel, discord.DMChannel):
             #print('reactionDM ran!')
             user = await self.bot.fetch_user(user_id)  # only do this once
@@ -1438,7 +1395,7 @@ class PollControls(commands.Cog):
             label = self.get_label(message)
             if not label:
                 return
-            server = await ask_for_server(self.bot, message, label)
+            server = await ask_for_server(self.bot, message, label, user)
         elif not channel:
             # discord rapidly closes dm channels by design
             # put private channels back into the bots cache and try again
@@ -1453,10 +1410,13 @@ class PollControls(commands.Cog):
             label = self.get_label(message)
             if not label:
                 return
-            server = await ask_for_server(self.bot, message, label)
+            server = await ask_for_server(self.bot, message, label, user)
         else:
             #print('reaction else ran!')
             return
+        if server is None:
+            # no shared server with this poll was found for the user
+            return
 
         p = await Poll.load_from_db(self.bot, server.id, label)
         #print('reaction getpoll ran!')
@@ -1475,8 +1435,8 @@ class PollControls(commands.Cog):
                 try:
                     await user.send('Sending you the requested export of "{}".'.format(p.short), file=discord.File(file_name))
                 except discord.Forbidden:
-                    config_result = await self.bot.db.config.find_one({'_id': str(server.id)})
-                    if config_result and not config_result.get('error_mess') or config_result and config_result.get('error_mess') == 'True':
+                    config_result = await self.bot.guild_config.get(server.id)
+                    if config_result.error_messages:
                         errormessage = traceback.format_exc(limit=0)
                         embederror = discord.Embed(title='Poll Reaction Error', color=discord.Color.red())
                         if errormessage.find("Cannot send messages to this user") >= 0:
@@ -1525,7 +1485,7 @@ class PollControls(commands.Cog):
                 if member.guild_permissions.manage_guild:
                     edit_rights = True
                 else:
-                    result = await self.bot.db.config.find_one({'_id': str(server.id)})
+                    result = await self.bot.guild_config.get(server.id)
                     if result and result.get('admin_role') in [r.name for r in member.roles]:
                         edit_rights = True
             else:
@@ -1534,7 +1494,7 @@ class PollControls(commands.Cog):
                 elif member.guild_permissions.manage_guild:
                     edit_rights = True
                 else:
-                    result = await self.bot.db.config.find_one({'_id': str(server.id)})
+                    result = await self.bot.guild_config.get(server.id)
                     if result and result.get('admin_role') in [r.name for r in member.roles]:
                         edit_rights = True
             embed.add_field(name='Can you manage the poll?', value=f'{"✅" if edit_rights else "❎"}', inline=False)
@@ -1574,8 +1534,8 @@ class PollControls(commands.Cog):
             try:
                 await user.send(embed=embed)
             except discord.Forbidden:
-                config_result = await self.bot.db.config.find_one({'_id': str(server.id)})
-                if config_result and not config_result.get('error_mess') or config_result and config_result.get('error_mess') == 'True':
+                config_result = await self.bot.guild_config.get(server.id)
+                if config_result.error_messages:
                     errormessage = traceback.format_exc(limit=0)
                     embederror = discord.Embed(title='Poll Reaction Error!', color=discord.Color.red())
                     if errormessage.find("Cannot send messages to this user") >= 0:
@@ -1670,8 +1630,8 @@ class PollControls(commands.Cog):
                     await member.send(f'You are not allowed to vote in this poll. Only users with '
                                 f'at least one of these roles can vote:\n{", ".join(p.roles)}')
                 except discord.Forbidden:
-                    config_result = await self.bot.db.config.find_one({'_id': str(server.id)})
-                    if config_result and not config_result.get('error_mess') or config_result and config_result.get('error_mess') == 'True':
+                    config_result = await self.bot.guild_config.get(server.id)
+                    if config_result.error_messages:
                         errormessage = traceback.format_exc(limit=0)
                         embederror = discord.Embed(title='Poll Reaction Error!', color=discord.Color.red())
                         if errormessage.find("Cannot send messages to this user") >= 0:
@@ -1691,6 +1651,9 @@ class PollControls(commands.Cog):
                 await message.remove_reaction(emoji, user)
 
                 # clean up all reactions (prevent lingering reactions)
+                if not isinstance(message, discord.Message):
+                    message = await channel.fetch_message(message_id)
+                    self.bot.message_cache.put(message_id, message)
                 for rct in message.reactions:
                     if rct.count > 1:
                         async for user in rct.users():
@@ -0,0 +1,68 @@
+import math
+import os
+import sys
+import time
+from collections import Counter
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+class ShardLoad:
+    """Events handled per shard, reported to the launcher to balance shards across clusters"""
+    def __init__(self, bot):
+        self.bot = bot
+        self._events = Counter()
+        self._since = time.monotonic()
+
+    def count(self, guild_id):
+        if guild_id is not None and self.bot.shard_count:
+            self._events[(int(guild_id) >> 22) % self.bot.shard_count] += 1
+
+    def snapshot(self):
+        """{shard_id: {'guilds', 'members', 'events_per_second'}} since the last snapshot"""
+        now = time.monotonic()
+        interval = max(now - self._since, 1)
+        shards = {shard_id: {'guilds': 0, 'members': 0, 'events_per_second': 0}
+                  for shard_id in (self.bot.shard_ids or [])}
+        for guild in self.bot.guilds:
+            shard = shards.setdefault(guild.shard_id, {'guilds': 0, 'members': 0, 'events_per_second': 0})
+            shard['guilds'] += 1
+            shard['members'] += guild.member_count or 0
+        for shard_id, events in self._events.items():
+            if shard_id in shards:
+                shards[shard_id]['events_per_second'] = events / interval
+        self._events.clear()
+        self._since = now
+        return shards
+
+
+def memory_usage():
+    """Resident memory of this process in bytes, the peak if the current value is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        # kilobytes on linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak * 1024 if sys.platform.startswith('linux') else peak
+    return None
+
+
+def health(bot, loop_lag=None):
+    """Heartbeat of a bot process: event loop lag, gateway latency per shard in ms, memory and guilds"""
+    latencies = {}
+    for shard_id, latency in bot.latencies:
+        latencies[shard_id] = None if math.isinf(latency) or math.isnan(latency) else round(latency * 1000)
+    return {
+        'pid': os.getpid(),
+        'loop_lag': loop_lag,
+        'latencies': latencies,
+        'memory': memory_usage(),
+        'guilds': len(bot.guilds),
+        'ready': bot.is_ready(),
+    }
@@ -0,0 +1,109 @@
+import datetime
+import logging
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger('discord')
+
+# (collection, keys, options) for every query shape the bot runs against mongo
+INDEXES = [
+    # Poll.load_from_db, save_to_db, delete and the name generator
+    ('polls', [('server_id', 1), ('short', 1)], {'name': 'server_short'}),
+    # looking up a label across all servers
+    ('polls', [('short', 1)], {'name': 'short'}),
+    # scheduler: open polls that are due to close
+    ('polls', [('open', 1), ('duration', 1)], {'name': 'open_duration'}),
+    # scheduler: prepared polls that are due to activate
+    ('polls', [('active', 1), ('activation', 1)], {'name': 'active_activation'}),
+    # show open/closed/prepared, newest first
+    ('polls', [('server_id', 1), ('open', 1), ('active', 1), ('_id', -1)], {'name': 'server_listing'}),
+    # one vote per user and choice; also serves lookups by poll and by poll and user
+    ('votes', [('poll_id', 1), ('user_id', 1), ('choice', 1)], {'name': 'poll_user_choice', 'unique': True}),
+    # polls a user voted on, to find the servers of a user for DM commands
+    ('votes', [('user_id', 1), ('poll_id', 1)], {'name': 'user_poll'}),
+    # all messages of a poll (poll deletion)
+    ('poll_messages', [('server_id', 1), ('short', 1)], {'name': 'server_short'}),
+]
+
+
+async def ensure_indexes(db):
+    """Create missing indexes, this is a no-op for indexes that already exist"""
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            # most likely duplicate votes from before the unique index, those have to be cleaned up by hand
+            logger.error(f'Could not create index {options["name"]} on {collection}: {e}')
+
+
+def query_shapes():
+    """Explain commands for the query shapes in models/poll.py, models/vote.py and cogs/poll_controls.py"""
+    poll_id = ObjectId()
+    now = datetime.datetime.utcnow()
+    return [
+        ('poll by label', {'find': 'polls', 'filter': {'server_id': '0', 'short': 'a'}}),
+        ('poll by label on any server', {'find': 'polls', 'filter': {'short': 'a'}}),
+        ('poll by label on servers of user', {'find': 'polls', 'filter': {
+            'server_id': {'$in': ['0', '1']}, 'short': 'a'}, 'projection': {'server_id': 1}}),
+        ('polls voted on by user', {'distinct': 'votes', 'key': 'poll_id', 'query': {'user_id': '0'}}),
+        ('servers of polls', {'distinct': 'polls', 'key': 'server_id', 'query': {'_id': {'$in': [poll_id]}}}),
+        ('polls due to close', {'find': 'polls', 'filter': {
+            'open': True, 'duration': {'$gte': now - datetime.timedelta(weeks=8), '$lte': now}}}),
+        ('polls due to activate', {'find': 'polls', 'filter': {
+            'active': False, 'activation': {'$gte': now - datetime.timedelta(weeks=8), '$lte': now}}}),
+        ('open polls of server', {'find': 'polls', 'filter': {'server_id': '0', 'open': True, 'active': True},
+                                  'sort': {'_id': -1}}),
+        ('prepared polls of server', {'find': 'polls', 'filter': {'server_id': '0', 'active': False},
+                                      'sort': {'_id': -1}}),
+        ('vote', {'find': 'votes', 'filter': {'poll_id': poll_id, 'user_id': '0', 'choice': 0}}),
+        ('votes of poll', {'find': 'votes', 'filter': {'poll_id': poll_id}}),
+        ('votes of user', {'find': 'votes', 'filter': {'poll_id': poll_id, 'user_id': '0'}}),
+        ('voters of poll', {'distinct': 'votes', 'key': 'user_id', 'query': {'poll_id': poll_id}}),
+        ('vote count rebuild', {'aggregate': 'votes', 'cursor': {}, 'pipeline': [
+            {'$match': {'poll_id': poll_id}},
+            {'$group': {'_id': '$choice', 'count': {'$sum': 1}, 'weight': {'$sum': '$weight'}}}]}),
+        ('messages of poll', {'find': 'poll_messages', 'filter': {'server_id': '0', 'short': 'a'}}),
+    ]
+
+
+def _plan_stages(plan, stages):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            _plan_stages(value, stages)
+    elif isinstance(plan, list):
+        for value in plan:
+            _plan_stages(value, stages)
+    return stages
+
+
+def _winning_plans(explain, plans):
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                plans.append(value)
+            else:
+                _winning_plans(value, plans)
+    elif isinstance(explain, list):
+        for value in explain:
+            _winning_plans(value, plans)
+    return plans
+
+
+async def audit_query_plans(db):
+    """Explain every query shape, returns a list of (name, stages, uses_collection_scan)"""
+    results = []
+    for name, command in query_shapes():
+        try:
+            explain = await db.command({'explain': command, 'verbosity': 'queryPlanner'})
+        except OperationFailure as e:
+            logger.warning(f'Could not explain query {name}: {e}')
+            results.append((name, ['ERROR'], True))
+            continue
+        stages = []
+        for plan in _winning_plans(explain, []):
+            _plan_stages(plan, stages)
+        results.append((name, stages, 'COLLSCAN' in stages))
+    return results
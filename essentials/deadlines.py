@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+
+import pytz
+
+logger = logging.getLogger('discord')
+
+
+def _as_utc(when):
+    if when.tzinfo is None or when.tzinfo.utcoffset(when) is None:
+        return pytz.utc.localize(when)
+    return when.astimezone(pytz.utc)
+
+
+class DeadlineScheduler:
+    """Closes and activates polls at their deadline
+
+    Upcoming deadlines are kept in a min-heap and a single task sleeps until the earliest one is due.
+    Changed or removed deadlines are not taken out of the heap, they are skipped when they come up
+    (the current deadline of every poll is kept in _current).
+    """
+    CLOSE = 'close'
+    ACTIVATE = 'activate'
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.handler = None  # coroutine function (kind, poll_id), set by the poll controls cog
+        self._heap = []
+        self._current = {}  # (kind, poll_id) -> deadline
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()  # handler tasks that have not finished yet
+
+    def __len__(self):
+        return self._current.__len__()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._running):
+            task.cancel()
+
+    def track(self, kind, poll_id, when):
+        key = (kind, str(poll_id))
+        if not isinstance(when, datetime.datetime):
+            self._current.pop(key, None)
+            return
+        when = _as_utc(when)
+        if self._current.get(key, None) == when:
+            return
+        self._current[key] = when
+        heapq.heappush(self._heap, (when, next(self._counter), kind, str(poll_id)))
+        if self._heap[0][0] == when:
+            # new earliest deadline, the waiting task has to recalculate its timeout
+            self._wakeup.set()
+
+    def untrack(self, kind, poll_id):
+        self._current.pop((kind, str(poll_id)), None)
+
+    def track_poll(self, poll):
+        """Update the deadlines of a poll after it was changed"""
+        self.track(self.CLOSE, poll.id, poll.duration if poll.open else None)
+        self.track(self.ACTIVATE, poll.id, poll.activation if not poll.active else None)
+
+    def untrack_poll(self, poll_id):
+        self.untrack(self.CLOSE, poll_id)
+        self.untrack(self.ACTIVATE, poll_id)
+
+    def owns(self, server_id):
+        """True if the server is on one of the shards of this process (also for servers the bot has left)"""
+        shard_ids = self.bot.shard_ids
+        if shard_ids is None or not self.bot.shard_count:
+            return True
+        return (int(server_id) >> 22) % self.bot.shard_count in shard_ids
+
+    async def load(self):
+        """Read all upcoming deadlines of this process's shards from the database
+
+        Deadlines that are already tracked are not duplicated, so this doubles as the reconcile pass.
+        """
+        since = datetime.datetime.utcnow() - datetime.timedelta(weeks=8)
+        shapes = [
+            (self.CLOSE, {'open': True, 'duration': {'$gte': since}}, 'duration'),
+            (self.ACTIVATE, {'active': False, 'activation': {'$gte': since}}, 'activation')
+        ]
+        for kind, query, field in shapes:
+            async for pd in self.bot.db.polls.find(query, {'_id': 1, 'server_id': 1, field: 1}):
+                if self.owns(pd['server_id']):
+                    self.track(kind, pd['_id'], pd[field])
+
+    async def _fire(self, kind, poll_id):
+        try:
+            await self.handler(kind, poll_id)
+        except Exception:
+            logger.exception(f'Deadline {kind} failed for poll {poll_id}')
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        while True:
+            self._wakeup.clear()
+            now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                when, _, kind, poll_id = heapq.heappop(self._heap)
+                if self._current.get((kind, poll_id), None) != when:
+                    continue
+                del self._current[(kind, poll_id)]
+                due.append((kind, poll_id))
+
+            # handlers run concurrently, the handler limits how much work is done at the same time
+            for kind, poll_id in due:
+                task = asyncio.get_event_loop().create_task(self._fire(kind, poll_id))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+            timeout = None
+            if self._heap:
+                # wake up at least every hour, the clock may have been adjusted in the meantime
+                timeout = min(3600.0, max(0.0, (self._heap[0][0] - now).total_seconds()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,88 @@
+import logging
+
+from essentials.lrucache import LRUCache
+from essentials.settings import SETTINGS
+
+logger = logging.getLogger('discord')
+
+
+class GuildConfig:
+    """A guild's document from the config collection
+
+    Is falsy if the guild has no config, and supports get() like the raw document.
+    """
+    def __init__(self, guild_id, document=None):
+        self.guild_id = str(guild_id)
+        self.document = document
+
+    def __bool__(self):
+        return self.document is not None
+
+    def get(self, key, default=None):
+        if self.document is None:
+            return default
+        return self.document.get(key, default)
+
+    @property
+    def prefix(self):
+        return self.get('prefix') or 'pm!'
+
+    @property
+    def admin_role(self):
+        return self.get('admin_role')
+
+    @property
+    def user_role(self):
+        return self.get('user_role')
+
+    @property
+    def error_messages(self):
+        """Send error messages to the channel when a DM fails (on unless switched off with /settings)"""
+        return bool(self) and (not self.get('error_mess') or self.get('error_mess') == 'True')
+
+    @property
+    def closed_poll_messages(self):
+        """Announce polls that reached their deadline (on unless switched off with /settings)"""
+        return bool(self) and (not self.get('closedpoll_mess') or self.get('closedpoll_mess') == 'True')
+
+
+class GuildConfigCache:
+    """Write-through cache of guild configs, all changes to the config collection should go through update()"""
+    def __init__(self, bot, maxsize=None, ttl=None):
+        self.bot = bot
+        self._cache = LRUCache(
+            maxsize=maxsize or SETTINGS.guild_config_cache_size,
+            ttl=ttl or SETTINGS.guild_config_cache_ttl
+        )
+
+    async def get(self, guild_id):
+        config = self._cache.get(str(guild_id), None)
+        if config is None:
+            document = await self.bot.db.config.find_one({'_id': str(guild_id)})
+            config = self.put(guild_id, document)
+        return config
+
+    def put(self, guild_id, document):
+        config = GuildConfig(guild_id, document)
+        self._cache.put(str(guild_id), config)
+        return config
+
+    async def update(self, guild_id, fields):
+        await self.bot.db.config.update_one({'_id': str(guild_id)}, {'$set': fields}, upsert=True)
+        cached = self._cache.get(str(guild_id), None)
+        if cached:
+            document = dict(cached.document)
+            document.update(fields)
+            self.put(guild_id, document)
+        else:
+            # the rest of the document is unknown, read it again on the next get
+            self._cache.pop(str(guild_id))
+        if 'prefix' in fields and getattr(self.bot, 'pre', None) is not None:
+            self.bot.pre[str(guild_id)] = fields['prefix']
+        self.bot.invalidator.guild(guild_id)
+
+    def forget(self, guild_id):
+        self._cache.pop(str(guild_id))
+
+    def stats(self):
+        return self._cache.stats()
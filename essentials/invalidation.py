@@ -0,0 +1,98 @@
+import asyncio
+import logging
+
+from bson import ObjectId
+
+logger = logging.getLogger('discord')
+
+TOPIC = 'invalidate'
+
+GUILD = 'guild'  # config or prefix of a guild changed
+POLL = 'poll'  # poll document changed (saved, closed, activated)
+POLL_DELETED = 'poll_deleted'  # also drops the cached messages of the poll
+VOTES = 'votes'  # votes of a poll changed
+
+
+class Invalidator:
+    """Tells the other clusters which cached data changed, over the IPC bus
+
+    Every process caches guild configs, prefixes, polls, voters and messages on its own. Whoever changes
+    the underlying data updates its local caches directly and calls one of the methods below, the other
+    clusters drop their copies when the event arrives. Events are collected for a few milliseconds and
+    published together. Without IPC (single process) this does nothing.
+    """
+    def __init__(self, bot, delay=0.05):
+        self.bot = bot
+        self.delay = delay
+        self._pending = []
+        self._task = None
+
+    async def start(self):
+        if self.enabled:
+            await self.bot.ipc.subscribe(TOPIC, self.receive)
+
+    @property
+    def enabled(self):
+        return getattr(self.bot, 'ipc', None) is not None
+
+    def guild(self, guild_id):
+        self._publish([GUILD, str(guild_id)])
+
+    def poll(self, server_id, short, poll_id=None):
+        self._publish([POLL, str(server_id), str(short), str(poll_id) if poll_id else None])
+
+    def poll_deleted(self, server_id, short, poll_id, message_ids=()):
+        self._publish([POLL_DELETED, str(server_id), str(short), str(poll_id), [str(m) for m in message_ids]])
+
+    def votes(self, poll_id):
+        self._publish([VOTES, str(poll_id)])
+
+    def _publish(self, event):
+        if not self.enabled:
+            return
+        if event not in self._pending:
+            self._pending.append(event)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._flush())
+
+    async def _flush(self):
+        # events queued while publishing are sent by the next round, _publish does not start a new task
+        # while this one runs
+        while self._pending:
+            await asyncio.sleep(self.delay)
+            events, self._pending = self._pending, []
+            try:
+                await self.bot.ipc.publish(TOPIC, events)
+            except Exception as e:
+                # the other clusters keep their copies until they expire
+                logger.warning(f'Could not publish {len(events)} cache invalidations: {e}')
+
+    async def receive(self, source, events):
+        for event in events or []:
+            try:
+                self.apply(event)
+            except Exception:
+                logger.exception(f'Could not apply cache invalidation {event} from {source}')
+
+    def apply(self, event):
+        """Drop the local copies of the data named by an event"""
+        kind = event[0]
+        bot = self.bot
+        if kind == GUILD:
+            bot.guild_config.forget(event[1])
+            # read again with the next message of the guild (get_server_pre)
+            getattr(bot, 'pre', {}).pop(event[1], None)
+        elif kind == POLL:
+            bot.poll_cache.invalidate(event[1], event[2])
+            if event[3]:
+                bot.poll_cache.invalidate_id(event[3])
+        elif kind == POLL_DELETED:
+            poll_id = ObjectId(event[3])
+            bot.poll_cache.forget(event[1], event[2])
+            bot.voter_cache.forget(poll_id)
+            bot.deadlines.untrack_poll(poll_id)
+            bot.refresh_scheduler.forget(poll_id, event[4])
+            for message_id in event[4]:
+                bot.message_cache.pop(int(message_id))
+        elif kind == VOTES:
+            bot.voter_cache.forget(ObjectId(event[1]))
@@ -0,0 +1,253 @@
+import asyncio
+import itertools
+import json
+import logging
+import struct
+
+import websockets
+
+logger = logging.getLogger('discord')
+
+VERSION = 1
+
+# frame kinds
+HELLO = 1  # client -> hub, payload {'role': ...}, source is the name of the client
+WELCOME = 2  # hub -> client
+REQUEST = 3  # payload {'command': ..., 'data': ...}, target is a client name or ALL
+RESPONSE = 4  # answer to a request, same id, target is the source of the request
+FANOUT = 5  # hub -> requester, payload {'targets': [...]}: the clients a request to ALL was sent to
+EVENT = 6  # publish, target is the topic
+SUBSCRIBE = 7  # client -> hub, target is the topic
+
+HUB = 'ipc'  # requests to the hub itself
+ALL = '*'  # requests to every cluster
+LAUNCHER = 'launcher'  # name of the launcher on the bus
+
+_HEADER = struct.Struct('!BBIHH')  # version, kind, id, source length, target length
+
+
+class Frame:
+    """One message on the bus: a small binary header, the source and target names and a JSON payload"""
+    __slots__ = ('kind', 'id', 'source', 'target', 'payload')
+
+    def __init__(self, kind, id=0, source='', target='', payload=None):
+        self.kind = kind
+        self.id = id
+        self.source = source
+        self.target = target
+        self.payload = payload
+
+    def encode(self):
+        source = self.source.encode('utf-8')
+        target = self.target.encode('utf-8')
+        payload = b'' if self.payload is None else json.dumps(self.payload, separators=(',', ':'),
+                                                               default=str).encode('utf-8')
+        return _HEADER.pack(VERSION, self.kind, self.id, len(source), len(target)) + source + target + payload
+
+    @staticmethod
+    def decode(data):
+        version, kind, frame_id, source_len, target_len = _HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError(f'Unsupported IPC frame version {version}')
+        offset = _HEADER.size
+        source = data[offset:offset + source_len].decode('utf-8')
+        offset += source_len
+        target = data[offset:offset + target_len].decode('utf-8')
+        offset += target_len
+        payload = json.loads(data[offset:]) if len(data) > offset else None
+        return Frame(kind, frame_id, source, target, payload)
+
+    @staticmethod
+    def peek(data):
+        """(kind, id, target) of an encoded frame without decoding the payload, used by the hub to route frames"""
+        _, kind, frame_id, source_len, target_len = _HEADER.unpack_from(data)
+        offset = _HEADER.size + source_len
+        return kind, frame_id, data[offset:offset + target_len].decode('utf-8')
+
+
+class IPCError(Exception):
+    pass
+
+
+class IPCClient:
+    """Connection of one process to the IPC hub (ipc.py)
+
+    Requests are answered by the handlers added with register(command, coroutine function). The handler
+    gets the request data and returns the response data, exceptions are returned to the requester as errors.
+    The client reconnects by itself when the hub restarts.
+    """
+    def __init__(self, name, url, role='cluster'):
+        self.name = name
+        self.url = url
+        self.role = role
+        self.websocket = None
+        self.connected = asyncio.Event()
+        self.handlers = {}
+        self.subscriptions = {}  # topic -> [callbacks]
+        self._ids = itertools.count(1)
+        self._pending = {}  # request id -> future or _Gather
+        self._closed = False
+
+    def register(self, command, handler):
+        self.handlers[command] = handler
+
+    async def run(self):
+        delay = 1
+        while not self._closed:
+            try:
+                async with websockets.connect(self.url, max_size=None) as ws:
+                    await ws.send(Frame(HELLO, source=self.name, payload={'role': self.role}).encode())
+                    welcome = Frame.decode(await ws.recv())
+                    if welcome.kind != WELCOME:
+                        raise IPCError(f'Unexpected answer from the hub: {welcome.payload}')
+                    self.websocket = ws
+                    for topic in self.subscriptions:
+                        await ws.send(Frame(SUBSCRIBE, source=self.name, target=topic).encode())
+                    self.connected.set()
+                    logger.info(f'IPC connected as {self.name}')
+                    delay = 1
+                    async for data in ws:
+                        self._dispatch(Frame.decode(data))
+            except asyncio.CancelledError:
+                raise
+            except websockets.ConnectionClosed as e:
+                if e.code == 4029:
+                    # the hub took a newer connection with the same name, keep retrying in case it goes away
+                    logger.error(f'IPC: replaced by another client named {self.name}')
+                else:
+                    logger.warning(f'IPC connection lost: {e}')
+            except (OSError, IPCError) as e:
+                logger.warning(f'IPC connection failed: {e}')
+            finally:
+                self.websocket = None
+                self.connected.clear()
+                self._fail_pending()
+            if not self._closed:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    async def close(self):
+        self._closed = True
+        if self.websocket is not None:
+            await self.websocket.close()
+
+    def _fail_pending(self):
+        for pending in self._pending.values():
+            pending.cancel_with(IPCError('IPC connection lost'))
+        self._pending.clear()
+
+    def _dispatch(self, frame):
+        if frame.kind == REQUEST:
+            asyncio.get_event_loop().create_task(self._answer(frame))
+        elif frame.kind in (RESPONSE, FANOUT):
+            pending = self._pending.get(frame.id, None)
+            if pending is not None:
+                pending.add(frame)
+                if pending.done():
+                    self._pending.pop(frame.id, None)
+        elif frame.kind == EVENT:
+            for callback in self.subscriptions.get(frame.target, []):
+                asyncio.get_event_loop().create_task(callback(frame.source, frame.payload))
+
+    async def _answer(self, frame):
+        command = (frame.payload or {}).get('command')
+        handler = self.handlers.get(command, None)
+        if handler is None:
+            payload = {'error': f'unknown command {command}'}
+        else:
+            try:
+                payload = {'data': await handler((frame.payload or {}).get('data'))}
+            except Exception as e:
+                logger.exception(f'IPC command {command} failed')
+                payload = {'error': f'{e.__class__.__name__}: {e}'}
+        try:
+            await self._send(Frame(RESPONSE, frame.id, self.name, frame.source, payload))
+        except (IPCError, websockets.ConnectionClosed) as e:
+            # the connection was lost while the handler ran, the requester gets an error or times out
+            logger.warning(f'IPC: could not answer {command} from {frame.source}: {e}')
+
+    async def _send(self, frame):
+        if self.websocket is None:
+            raise IPCError('Not connected to the IPC hub')
+        await self.websocket.send(frame.encode())
+
+    async def request(self, target, command, data=None, timeout=5):
+        """Send a command to one client (or the hub) and return the data of its answer"""
+        frame_id = next(self._ids)
+        pending = _Single()
+        self._pending[frame_id] = pending
+        try:
+            await self._send(Frame(REQUEST, frame_id, self.name, target, {'command': command, 'data': data}))
+            response = await asyncio.wait_for(pending.future, timeout)
+        finally:
+            self._pending.pop(frame_id, None)
+        if 'error' in response:
+            raise IPCError(f'{target}: {response["error"]}')
+        return response.get('data')
+
+    async def ask_all(self, command, data=None, timeout=5):
+        """Send a command to every cluster, returns {cluster: data or IPCError} of the answers within timeout
+
+        The hub tells which clusters it sent the request to, so this returns as soon as all of them answered.
+        """
+        frame_id = next(self._ids)
+        pending = _Gather()
+        self._pending[frame_id] = pending
+        try:
+            await self._send(Frame(REQUEST, frame_id, self.name, ALL, {'command': command, 'data': data}))
+            try:
+                await asyncio.wait_for(pending.future, timeout)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            self._pending.pop(frame_id, None)
+        return {name: IPCError(response['error']) if 'error' in response else response.get('data')
+                for name, response in pending.responses.items()}
+
+    async def publish(self, topic, data=None):
+        await self._send(Frame(EVENT, 0, self.name, topic, data))
+
+    async def subscribe(self, topic, callback):
+        """callback(source, data) is called for every event published on the topic by another client"""
+        first = topic not in self.subscriptions
+        self.subscriptions.setdefault(topic, []).append(callback)
+        if first and self.websocket is not None:
+            await self._send(Frame(SUBSCRIBE, 0, self.name, topic))
+
+
+class _Single:
+    def __init__(self):
+        self.future = asyncio.get_event_loop().create_future()
+
+    def add(self, frame):
+        if frame.kind == RESPONSE and not self.future.done():
+            self.future.set_result(frame.payload or {})
+
+    def done(self):
+        return self.future.done()
+
+    def cancel_with(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class _Gather:
+    def __init__(self):
+        self.future = asyncio.get_event_loop().create_future()
+        self.targets = None
+        self.responses = {}
+
+    def add(self, frame):
+        if frame.kind == FANOUT:
+            self.targets = set(frame.payload['targets'])
+        else:
+            self.responses[frame.source] = frame.payload or {}
+        if self.targets is not None and self.targets <= set(self.responses) and not self.future.done():
+            self.future.set_result(None)
+
+    def done(self):
+        return self.future.done()
+
+    def cancel_with(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
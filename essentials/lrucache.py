@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    """Bounded mapping with least recently used eviction and optional expiry per entry
+
+    Counts hits, misses, evictions and expirations so the caches can be sized from real usage.
+    """
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return self._data.__len__()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires, value = entry
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while self._data.__len__() > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def items(self):
+        """Snapshot of all entries that are not expired, does not count as hits or change the LRU order"""
+        now = time.monotonic()
+        return [(k, v) for k, (expires, v) in self._data.items() if expires is None or expires >= now]
+
+    def clear(self):
+        self._data = OrderedDict()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': self._data.__len__(),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
@@ -1,30 +1,47 @@
 import logging
-from collections import defaultdict
 
 import discord
 
+from essentials.lrucache import LRUCache, MISSING
+from essentials.settings import SETTINGS
+
 logger = logging.getLogger('discord')
 
+# marks members that could not be fetched, so guild.fetch_member is not retried on every lookup
+NOT_FOUND = object()
+
 
 class MemberCache:
-    def __init__(self):
-        self._cache_dict = defaultdict(dict)
+    def __init__(self, maxsize=None, ttl=None, negative_ttl=None):
+        self._cache = LRUCache(
+            maxsize=maxsize or SETTINGS.member_cache_size,
+            ttl=ttl or SETTINGS.member_cache_ttl
+        )
+        self.negative_ttl = negative_ttl or SETTINGS.member_cache_negative_ttl
 
     async def add(self, guild: discord.Guild, member_id: int) -> discord.Member:
         try:
             member = await guild.fetch_member(member_id)
-            self._cache_dict[guild.id][member_id] = member
-            if len(self._cache_dict[guild.id]) % 1 == 0:
-                logger.info("member cache size: " + str(len(self._cache_dict[guild.id])))
+            self._cache.put((guild.id, member_id), member)
             return member
-        except:
+        except (discord.NotFound, discord.Forbidden):
+            self._cache.put((guild.id, member_id), NOT_FOUND, ttl=self.negative_ttl)
+        except discord.HTTPException as e:
+            # rate limits and server errors say nothing about the member, the next lookup tries again
+            logger.debug(f'Could not fetch member {member_id} of guild {guild.id}: {e}')
+        except Exception:
             pass
 
     async def get(self, guild: discord.Guild, member_id: int) -> discord.Member:
-        member = self._cache_dict[guild.id].get(member_id, None)
-        if not member:
+        member = self._cache.get((guild.id, member_id), MISSING)
+        if member is NOT_FOUND:
+            return None
+        if member is MISSING:
             member = await self.add(guild, member_id)
         return member
 
+    def stats(self):
+        return self._cache.stats()
+
     def clear(self):
-        self._cache_dict = defaultdict(dict)
\ No newline at end of file
+        self._cache.clear()
@@ -1,23 +1,33 @@
 import logging
 import discord
 
+from essentials.lrucache import LRUCache
+from essentials.settings import SETTINGS
+
 logger = logging.getLogger('discord')
 
 
 class MessageCache:
-    def __init__(self, bot):
+    def __init__(self, bot, maxsize=None, ttl=None):
         self.bot = bot
-        self._cache_dict = {}
+        self._cache = LRUCache(
+            maxsize=maxsize or SETTINGS.message_cache_size,
+            ttl=ttl or SETTINGS.message_cache_ttl
+        )
 
     def put(self, key, value: discord.Message):
-        self._cache_dict[key] = value
-        if self._cache_dict.__len__() % 5 == 0:
-            logger.info("cache size: " + str(self._cache_dict.__len__()))
+        self._cache.put(key, value)
 
     def get(self, key):
         # Try to find it in this cache, then see if it is cached in the bots own message cache
-        message = self._cache_dict.get(key, None)
+        message = self._cache.get(key, None)
         return message
 
+    def pop(self, key):
+        return self._cache.pop(key, None)
+
+    def stats(self):
+        return self._cache.stats()
+
     def clear(self):
-        self._cache_dict = {}
\ No newline at end of file
+        self._cache.clear()
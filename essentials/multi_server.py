@@ -24,20 +24,24 @@ async def get_pre(bot, message):
 
 async def get_server_pre(bot, server):
     """Gets the prefix for a server."""
-    serverowner = str(server.owner_id)
     try:
         result = bot.pre[str(server.id)]
     except KeyError:
-        print('bot config was not found for server:', server.id)
-        logger.info(f'bot config was not found for server: {server.id}')
-        # if not cached, insert into DB (this will override the configs, but they were not found to begin with)
-        await bot.db.config.update_one(
-            {'_id': str(server.id)},
-            {'$set': {'prefix': 'pm!', 'admin_role': 'polladmin', 'user_role': 'polluser', 'in_guild': 'True', 'ownerid': serverowner, 'timeleave': 'None'}},
-            upsert=True
-        )
-        bot.pre[str(server.id)] = 'pm!'
-        return 'pm!'
+        if getattr(bot, 'db', None) is None:
+            # bot not ready
+            return 'pm!'
+        # not loaded in a batch yet (e.g. a guild that just became available), fetch only this guild
+        config = await bot.guild_config.get(server.id)
+        if not config:
+            print('bot config was not found for server:', server.id)
+            logger.info(f'bot config was not found for server: {server.id}')
+            # insert the default config, only if there is none so existing configs are not overridden
+            await bot.guild_config.update(
+                server.id,
+                {'prefix': 'pm!', 'admin_role': 'polladmin', 'user_role': 'polluser', 'in_guild': 'True', 'ownerid': str(server.owner_id), 'timeleave': 'None'}
+            )
+        result = config.prefix
+        bot.pre[str(server.id)] = result
     except AttributeError:
         # bot not ready
         return 'pm!'
@@ -46,33 +50,35 @@ async def get_server_pre(bot, server):
     return result
 
 
-async def get_servers(bot, message, short=None):
+async def load_prefixes(bot, guilds, batch_size=500):
+    """Load prefixes and configs of the guilds that are not cached yet with one $in query per batch"""
+    guild_ids = [str(g.id) for g in guilds if str(g.id) not in bot.pre]
+    for i in range(0, len(guild_ids), batch_size):
+        async for entry in bot.db.config.find({'_id': {'$in': guild_ids[i:i + batch_size]}}):
+            bot.pre[entry['_id']] = entry.get('prefix', 'pm!')
+            bot.guild_config.put(entry['_id'], entry)
+
+
+async def get_servers(bot, message, short=None, user=None):
     """Get best guess of relevant shared servers"""
     if message.guild is None:
-        list_of_shared_servers = []
-        for s in bot.guilds:
-            if message.author.id in [m.id for m in s.members]:
-                list_of_shared_servers.append(s)
-        if short is not None:
-            query = bot.db.polls.find({'short': short})
-            if query is not None:
-                server_ids_with_short = [poll['server_id'] async for poll in query]
-                servers_with_short = [bot.get_guild(int(x)) for x in server_ids_with_short]
-                shared_servers_with_short = list(set(servers_with_short).intersection(set(list_of_shared_servers)))
-                if shared_servers_with_short.__len__() >= 1:
-                    return shared_servers_with_short
+        user = user or message.author
+        list_of_shared_servers = await bot.user_guilds.get(user.id)
+        if short is not None and list_of_shared_servers:
+            by_id = {str(s.id): s for s in list_of_shared_servers}
+            query = bot.db.polls.find({'server_id': {'$in': list(by_id)}, 'short': short}, {'server_id': 1})
+            shared_servers_with_short = list({by_id[poll['server_id']] async for poll in query})
+            if shared_servers_with_short.__len__() >= 1:
+                return shared_servers_with_short
 
         # do this if no shared server with short is found
-        if list_of_shared_servers.__len__() == 0:
-            return []
-        else:
-            return list_of_shared_servers
+        return list_of_shared_servers
     else:
         return [message.guild]
 
 
-async def ask_for_server(bot, message, short=None):
-    server_list = await get_servers(bot, message, short)
+async def ask_for_server(bot, message, short=None, user=None):
+    server_list = await get_servers(bot, message, short, user)
     if server_list.__len__() == 1:
         return server_list[0]
     else:  # server_list.__len__() == 0:
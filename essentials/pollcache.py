@@ -0,0 +1,81 @@
+import logging
+
+from essentials.lrucache import LRUCache
+from essentials.settings import SETTINGS
+
+logger = logging.getLogger('discord')
+
+
+class PollCache:
+    """Per-process cache of poll documents
+
+    Documents are keyed by (server_id, short) and additionally indexed by the id of every message the
+    poll was posted in. Cached documents are shared, callers must not modify them in place.
+    """
+    def __init__(self, maxsize=None, ttl=None):
+        maxsize = maxsize or SETTINGS.poll_cache_size
+        self.ttl = ttl or SETTINGS.poll_cache_ttl
+        self._polls = LRUCache(maxsize=maxsize, ttl=self.ttl)
+        self._ids = LRUCache(maxsize=maxsize)
+        # message ids are cheap to keep and save a fetch per reaction, so allow more of them than documents
+        self._messages = LRUCache(maxsize=maxsize * 4)
+
+    @staticmethod
+    def _key(server_id, short):
+        return str(server_id), str(short)
+
+    def get(self, server_id, short):
+        return self._polls.get(self._key(server_id, short), None)
+
+    def get_by_message(self, message_id):
+        key = self._messages.get(int(message_id), None)
+        if not key:
+            return None
+        return self.get(*key)
+
+    def put(self, document):
+        key = self._key(document['server_id'], document['short'])
+        self._polls.put(key, document)
+        if '_id' in document:
+            self._ids.put(str(document['_id']), key)
+
+    def link_message(self, message_id, server_id, short):
+        self._messages.put(int(message_id), self._key(server_id, short))
+
+    def mark_not_poll(self, message_id):
+        self._messages.put(int(message_id), False)
+
+    def resolve_message(self, message_id):
+        """(server_id, short) of a known poll message, False for a known non-poll message, otherwise None"""
+        return self._messages.get(int(message_id), None)
+
+    def invalidate(self, server_id, short):
+        self._drop(self._key(server_id, short))
+
+    def invalidate_id(self, poll_id):
+        key = self._ids.get(str(poll_id), None)
+        if key is not None:
+            self._drop(key)
+
+    def forget(self, server_id, short):
+        """Drop the poll and every message linked to it (used when a poll is deleted)"""
+        key = self._key(server_id, short)
+        self._drop(key)
+        for message_id in [m for m, k in self._messages.items() if k == key]:
+            self._messages.pop(message_id)
+
+    def _drop(self, key):
+        document = self._polls.pop(key, None)
+        if document is not None and '_id' in document:
+            self._ids.pop(str(document['_id']), None)
+
+    def stats(self):
+        return {
+            'polls': self._polls.stats(),
+            'poll messages': self._messages.stats()
+        }
+
+    def clear(self):
+        self._polls.clear()
+        self._ids.clear()
+        self._messages.clear()
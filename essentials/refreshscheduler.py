@@ -0,0 +1,92 @@
+import asyncio
+import json
+import logging
+import time
+
+import discord
+
+from essentials.lrucache import LRUCache
+
+logger = logging.getLogger('discord')
+
+
+class RefreshScheduler:
+    """Coalesces edits of poll embeds
+
+    A poll is edited at most once per window. Refreshes inside the window only remember the latest poll
+    state and message, which are edited together once the window is over. Edits in the same channel are
+    spaced out so busy channels stay below Discord's edit rate limit.
+    """
+    def __init__(self, bot, window=5, channel_spacing=1):
+        self.bot = bot
+        self.window = window
+        self.channel_spacing = channel_spacing
+        self._blocked = {}  # poll id -> end of the current window
+        self._dirty = {}  # poll id -> (poll, message) waiting for the window to end
+        self._channel_next = {}  # channel id -> earliest time for the next edit
+        self._last_sent = LRUCache(maxsize=5000)  # message id -> serialized embed of the last edit
+
+    def request(self, poll, message, force=False):
+        """Returns the edit coroutine if the poll can be edited right away, otherwise marks it dirty"""
+        pid = str(poll.id)
+        now = time.monotonic()
+        if not force and (self._blocked.get(pid, 0) > now or self._channel_busy(message, now)):
+            self._dirty[pid] = (poll, message)
+            self._blocked.setdefault(pid, now)
+            return None
+        self._dirty.pop(pid, None)
+        self._blocked[pid] = now + self.window
+        return self._edit(poll, message)
+
+    async def flush(self):
+        """Edit all dirty polls whose window is over"""
+        now = time.monotonic()
+        due = []
+        for pid, until in list(self._blocked.items()):
+            if until > now:
+                continue
+            entry = self._dirty.pop(pid, None)
+            if entry is None:
+                del self._blocked[pid]
+                continue
+            poll, message = entry
+            if self._channel_busy(message, now):
+                self._dirty[pid] = entry
+                continue
+            self._blocked[pid] = now + self.window
+            # reserve the channel now, so a second poll in the same channel waits for the next flush
+            self._channel_next[message.channel.id] = now + self.channel_spacing
+            due.append(self._edit(poll, message))
+
+        for channel_id in [c for c, t in self._channel_next.items() if t <= now]:
+            del self._channel_next[channel_id]
+
+        if due:
+            await asyncio.gather(*due)
+
+    def forget(self, poll_id, message_ids=()):
+        """Drop pending edits of a deleted poll"""
+        self._dirty.pop(str(poll_id), None)
+        self._blocked.pop(str(poll_id), None)
+        for message_id in message_ids:
+            self._last_sent.pop(int(message_id))
+
+    def _channel_busy(self, message, now):
+        return self._channel_next.get(message.channel.id, 0) > now
+
+    async def _edit(self, poll, message):
+        # the poll object may have been rendered before, make sure the counts are read again
+        poll.vote_counts = {}
+        poll.vote_counts_weighted = {}
+        embed = await poll.generate_embed()
+        rendered = json.dumps(embed.to_dict(), sort_keys=True, default=str)
+        if self._last_sent.get(message.id, None) == rendered:
+            # nothing visible changed (e.g. a vote was added and removed again)
+            return
+        self._channel_next[message.channel.id] = time.monotonic() + self.channel_spacing
+        try:
+            await message.edit(embed=embed)
+            self._last_sent.put(message.id, rendered)
+        except discord.HTTPException as e:
+            self._last_sent.pop(message.id)
+            logger.warning(f'Could not refresh poll {poll.short} ({poll.id}): {e}')
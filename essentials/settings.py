@@ -15,6 +15,54 @@ class Settings:
         self.invite_link = \
             'https://discord.com/oauth2/authorize?client_id=753217458029985852&permissions=275951774784&scope=bot%20applications.commands'
 
+        # cache limits, applied per process (every cluster keeps its own caches)
+        self.message_cache_size = 5000
+        self.message_cache_ttl = 3600 #seconds
+        self.member_cache_size = 50000
+        self.member_cache_ttl = 3600 #seconds
+        self.member_cache_negative_ttl = 300 #seconds to remember members that could not be fetched
+        self.poll_cache_size = 5000
+        self.poll_cache_ttl = 600 #seconds
+        self.voter_cache_size = 500 #polls
+        self.voter_cache_ttl = 1800 #seconds
+        self.guild_config_cache_size = 20000
+        self.guild_config_cache_ttl = 3600 #seconds
+        self.user_guild_cache_size = 50000 #users
+        self.user_guild_cache_ttl = 3600 #seconds
+        # overrides for single clusters, e.g. {'Alpha': {'member_cache_size': 100000}}
+        self.cluster_cache_config = {}
+
+        # closing and activating polls: polls processed at the same time
+        self.deadline_workers = 10
+        # Discord rate limits kept by the announcements, (requests, seconds): messages and reactions in one
+        # channel and all requests of this process (the global limit of the bot is shared by all clusters)
+        self.deadline_channel_messages = (5, 5)
+        self.deadline_channel_reactions = (1, 0.25)
+        self.deadline_global_requests = (50, 1)
+
+        # launcher: shards per cluster, or a fixed number of clusters (None: as many as shards_per_cluster needs)
+        self.shards_per_cluster = 4
+        self.cluster_count = None
+        # 'fixed' packs consecutive shards, 'balanced' packs by the load recorded in cluster_stats_file
+        self.cluster_packing = 'fixed'
+        self.cluster_stats_file = 'cluster-stats.json'
+        self.cluster_stats_interval = 60 #seconds between load reports of a cluster
+        self.ipc_port = 42069 #port of the IPC hub (ipc.py)
+        # cluster health: heartbeats, clusters without one for the timeout are restarted
+        self.cluster_heartbeat_interval = 10 #seconds
+        self.cluster_heartbeat_timeout = 90 #seconds
+        self.cluster_ready_timeout = 900 #seconds for a cluster to connect all its shards
+        # restarts of crashed clusters wait backoff * 2^(crashes - 1) seconds, up to backoff_max
+        self.cluster_restart_backoff = 5
+        self.cluster_restart_backoff_max = 600
+        self.cluster_stable_after = 600 #seconds running before the crash count is reset
+
+        # polls with more votes than this are deleted without a transaction, which would hit its time limit
+        self.vote_delete_transaction_max = 10000
+        # exports: voters whose names are looked up at the same time and characters (or bytes) buffered per file write
+        self.export_batch_size = 50
+        self.export_buffer_size = 65536
+
         self.load_secrets()
 
     def load_secrets(self):
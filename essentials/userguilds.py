@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import time
+
+from essentials.lrucache import LRUCache
+from essentials.settings import SETTINGS
+
+logger = logging.getLogger('discord')
+
+
+class UserGuilds:
+    __slots__ = ('ids', 'loaded')
+
+    def __init__(self):
+        self.ids = set()
+        self.loaded = None  # when the vote history was read (time.monotonic)
+
+
+class UserGuildIndex:
+    """Guilds shared with a user, user id -> set of guild ids
+
+    Filled by member events, messages, reactions on polls and votes, these guilds are kept until the user
+    is evicted or leaves the guild. Lookups read the guilds of the vote history from the DB, the first time
+    and again after `ttl` seconds. With the members intent they also check the member cache of every guild,
+    so users that never voted or were evicted are found as well.
+    """
+    def __init__(self, bot, maxsize=None, ttl=None):
+        self.bot = bot
+        self.ttl = ttl or SETTINGS.user_guild_cache_ttl
+        self._users = LRUCache(maxsize=maxsize or SETTINGS.user_guild_cache_size)
+        self._loading = {}  # user id -> task
+
+    def add(self, user_id, guild_id):
+        entry = self._users.get(str(user_id), None)
+        if entry is None:
+            entry = UserGuilds()
+            self._users.put(str(user_id), entry)
+        entry.ids.add(int(guild_id))
+
+    def discard(self, user_id, guild_id):
+        entry = self._users.get(str(user_id), None)
+        if entry is not None:
+            entry.ids.discard(int(guild_id))
+
+    async def _load(self, user_id):
+        ids = set()
+        poll_ids = await self.bot.db.votes.distinct('poll_id', {'user_id': str(user_id)})
+        if poll_ids:
+            server_ids = await self.bot.db.polls.distinct('server_id', {'_id': {'$in': poll_ids}})
+            ids.update(int(s) for s in server_ids)
+        if self.bot.intents.members:
+            # get_member is a dict lookup in the complete member cache
+            ids.update(g.id for g in self.bot.guilds if g.get_member(int(user_id)) is not None)
+
+        entry = self._users.get(str(user_id), None)
+        if entry is None:
+            entry = UserGuilds()
+            self._users.put(str(user_id), entry)
+        # keep guilds added by events while the history was read
+        entry.ids.update(ids)
+        entry.loaded = time.monotonic()
+        return entry
+
+    async def get(self, user_id):
+        """Guilds of this bot process the user is known to share"""
+        entry = self._users.get(str(user_id), None)
+        if entry is None or entry.loaded is None or time.monotonic() - entry.loaded > self.ttl:
+            task = self._loading.get(str(user_id), None)
+            if task is None:
+                task = asyncio.get_event_loop().create_task(self._load(user_id))
+                self._loading[str(user_id)] = task
+                task.add_done_callback(lambda t: self._loading.pop(str(user_id), None))
+            entry = await asyncio.shield(task)
+        guilds = [self.bot.get_guild(guild_id) for guild_id in entry.ids]
+        return [g for g in guilds if g is not None]
+
+    def stats(self):
+        return self._users.stats()
+
+    def clear(self):
+        self._users.clear()
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from models.vote import Vote
+
+logger = logging.getLogger('discord')
+
+SAVE = 'save'
+DELETE = 'delete'
+
+
+class VoteWriter:
+    """Collects vote writes for a few milliseconds and sends them with one unordered bulk_write
+
+    A batch contains at most one write per user and poll, later writes of the same user wait for the next
+    batch. Batches are written one after another, so the writes of a user to a poll keep their order
+    (e.g. removing the old choice before adding the new one of a single choice poll).
+    The vote counters are updated before the callers are answered. Every caller gets the result of its
+    own write: True if the vote was inserted or deleted, False if there was nothing to do and None if it
+    could not be determined.
+    """
+    def __init__(self, bot, delay=0.005, max_batch=500):
+        self.bot = bot
+        self.delay = delay
+        self.max_batch = max_batch
+        self._pending = []  # (kind, vote, future)
+        self._task = None
+
+    async def save(self, vote):
+        return await self._enqueue(SAVE, vote)
+
+    async def delete(self, vote):
+        return await self._enqueue(DELETE, vote)
+
+    def _enqueue(self, kind, vote):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((kind, vote, future))
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        return future
+
+    async def _run(self):
+        await asyncio.sleep(self.delay)
+        while self._pending:
+            batch = []
+            later = []
+            keys = set()
+            for op in self._pending:
+                key = (op[1].poll_id, str(op[1].user_id))
+                if key in keys or len(batch) >= self.max_batch:
+                    later.append(op)
+                else:
+                    keys.add(key)
+                    batch.append(op)
+            self._pending = later
+            try:
+                await self._write(batch)
+            except Exception as e:
+                logger.exception('Writing a batch of votes failed')
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _write(self, batch):
+        requests = []
+        for kind, vote, _ in batch:
+            key = {'poll_id': vote.poll_id, 'user_id': str(vote.user_id), 'choice': vote.choice}
+            if kind == SAVE:
+                # only insert, an existing vote for the same choice is left alone so the counters stay exact
+                requests.append(UpdateOne(key, {'$setOnInsert': vote.to_dict()}, upsert=True))
+            else:
+                requests.append(DeleteOne(key))
+
+        try:
+            result = (await self.bot.db.votes.bulk_write(requests, ordered=False)).bulk_api_result
+        except BulkWriteError as e:
+            # e.g. a duplicate key when the same vote was inserted by another process at the same time
+            result = e.details
+
+        upserted = {u['index']: u['_id'] for u in result.get('upserted', [])}
+        failed = {err['index'] for err in result.get('writeErrors', [])}
+        deletes = [i for i, op in enumerate(batch) if op[0] == DELETE and i not in failed]
+        # bulk results only have the total number of deleted documents. If some deletes found nothing,
+        # it is unknown which ones, so the counters of those polls are rebuilt instead
+        deletes_known = result.get('nRemoved', 0) == len(deletes)
+
+        increments = {}
+        rebuild = set()
+        results = []
+        for i, (kind, vote, _) in enumerate(batch):
+            if kind == SAVE:
+                done = i in upserted
+                if done:
+                    vote._id = upserted[i]
+                    self._count(increments, vote, 1)
+            elif i in failed:
+                done = False
+            elif deletes_known:
+                done = True
+                self._count(increments, vote, -1)
+            else:
+                done = None
+                rebuild.add(vote.poll_id)
+            results.append(done)
+
+        count_requests = [UpdateOne({'_id': poll_id}, {'$inc': inc}, upsert=True)
+                          for poll_id, inc in increments.items() if poll_id not in rebuild]
+        if count_requests:
+            try:
+                await self.bot.db.poll_counts.bulk_write(count_requests, ordered=False)
+            except Exception as e:
+                # it is unknown which increments were applied, count these polls from their votes
+                logger.warning(f'Updating the vote counters of {len(count_requests)} polls failed: {e}')
+                rebuild.update(increments)
+        for poll_id in rebuild:
+            try:
+                await Vote.rebuild_counts_for_poll(self.bot, poll_id)
+            except Exception:
+                logger.exception(f'Could not rebuild the vote counters of poll {poll_id}')
+
+        # other clusters may have the voters of these polls cached (e.g. from votes in DMs)
+        for poll_id in {vote.poll_id for kind, vote, _ in batch}:
+            self.bot.invalidator.votes(poll_id)
+
+        # answer the callers once the counters match the votes, so a refresh after the vote shows it
+        for (_, _, future), done in zip(batch, results):
+            if not future.done():
+                future.set_result(done)
+
+    @staticmethod
+    def _count(increments, vote, sign):
+        inc = increments.setdefault(vote.poll_id, {})
+        raw = f'raw.{vote.choice}'
+        weighted = f'weighted.{vote.choice}'
+        inc[raw] = inc.get(raw, 0) + sign
+        inc[weighted] = inc.get(weighted, 0) + sign * vote.weight
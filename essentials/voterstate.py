@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+from essentials.lrucache import LRUCache
+from essentials.settings import SETTINGS
+
+logger = logging.getLogger('discord')
+
+
+class VoterStateCache:
+    """Choices of every voter of a poll, user id -> {choice: weight}
+
+    A poll is loaded with one query the first time one of its voters is looked up and kept up to date by
+    Poll.vote and Poll.unvote, so duplicate and multiple choice checks need no database read.
+    """
+    def __init__(self, bot, maxsize=None, ttl=None):
+        self.bot = bot
+        self._polls = LRUCache(
+            maxsize=maxsize or SETTINGS.voter_cache_size,
+            ttl=ttl or SETTINGS.voter_cache_ttl
+        )
+        self._loading = {}  # poll id -> task, so a poll is only queried once when many votes arrive together
+
+    async def _load(self, poll_id):
+        voters = {}
+        query = self.bot.db.votes.find({'poll_id': poll_id}, {'_id': 0, 'user_id': 1, 'choice': 1, 'weight': 1})
+        async for v in query:
+            voters.setdefault(v['user_id'], {})[v['choice']] = v.get('weight', 1)
+        self._polls.put(poll_id, voters)
+        return voters
+
+    async def _voters(self, poll_id):
+        voters = self._polls.get(poll_id, None)
+        if voters is not None:
+            return voters
+        task = self._loading.get(poll_id, None)
+        if task is None:
+            task = asyncio.get_event_loop().create_task(self._load(poll_id))
+            self._loading[poll_id] = task
+            task.add_done_callback(lambda t: self._loading.pop(poll_id, None))
+        return await asyncio.shield(task)
+
+    async def choices(self, poll_id, user_id):
+        """Copy of the choices of a user as {choice: weight}"""
+        voters = await self._voters(poll_id)
+        return dict(voters.get(str(user_id), {}))
+
+    def reserve(self, poll_id, user_id, choice, weight):
+        """Record a vote before it is written, so reactions that arrive in the meantime already see it"""
+        voters = self._polls.get(poll_id, None)
+        if voters is not None:
+            voters.setdefault(str(user_id), {})[choice] = weight
+
+    def release(self, poll_id, user_id, choice):
+        voters = self._polls.get(poll_id, None)
+        if voters is not None:
+            user_choices = voters.get(str(user_id), {})
+            user_choices.pop(choice, None)
+            if not user_choices:
+                voters.pop(str(user_id), None)
+
+    def forget(self, poll_id):
+        self._polls.pop(poll_id)
+
+    def stats(self):
+        return self._polls.stats()
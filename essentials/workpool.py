@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Request budget for a Discord route, refills `rate` tokens per second up to `capacity`"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens=1):
+        # the lock keeps waiters in order, so a large request is not starved by small ones
+        async with self._lock:
+            self._refill()
+            while self._tokens < tokens:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
+
+
+class KeyedTokenBuckets:
+    """A TokenBucket per key, e.g. per channel, since Discord limits the requests of every channel on its own
+
+    Buckets that are full again are dropped, so keys that are not used any more do not pile up.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}  # key -> [bucket, number of users]
+
+    async def acquire(self, key, tokens=1):
+        entry = self._buckets.setdefault(key, [TokenBucket(self.rate, self.capacity), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire(tokens)
+        finally:
+            entry[1] -= 1
+        self._prune()
+
+    def _prune(self):
+        for key, (bucket, users) in list(self._buckets.items()):
+            if users == 0:
+                bucket._refill()
+                if bucket._tokens >= bucket.capacity:
+                    del self._buckets[key]
+
+
+class RouteLimiter:
+    """Rate limits of Discord routes: a KeyedTokenBuckets per route and one TokenBucket for all requests
+
+    routes: {route: (requests, seconds)} allowed per key (e.g. per channel), total: (requests, seconds)
+    of all routes together.
+    """
+    def __init__(self, routes, total):
+        self._routes = {route: KeyedTokenBuckets(requests / seconds, requests)
+                        for route, (requests, seconds) in routes.items()}
+        self._total = TokenBucket(total[0] / total[1], total[0])
+
+    async def acquire(self, key, route):
+        # the route first, so requests waiting for a busy channel do not hold tokens of the other channels
+        await self._routes[route].acquire(key)
+        await self._total.acquire()
+
+
+class KeyedWorkerPool:
+    """Runs coroutines with at most `size` at a time and never two with the same key concurrently
+
+    Used with channel ids as keys: different channels and guilds are processed in parallel while the
+    messages of one channel stay in order.
+    """
+    def __init__(self, size=10):
+        self.size = size
+        self._semaphore = asyncio.Semaphore(size)
+        self._locks = {}  # key -> [lock, number of users]
+
+    async def run(self, key, coro_fn, *args, **kwargs):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # wait for the key first, so waiting on a busy channel does not block a worker slot
+            async with entry[0]:
+                async with self._semaphore:
+                    return await coro_fn(*args, **kwargs)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def busy_keys(self):
+        return self._locks.__len__()
@@ -1,40 +1,107 @@
 import asyncio
+import logging
 import signal
+import sys
+
 import websockets
 
+from essentials.ipc_protocol import Frame, HELLO, WELCOME, REQUEST, RESPONSE, FANOUT, EVENT, SUBSCRIBE, HUB, ALL
+from essentials.settings import SETTINGS
+
+log = logging.getLogger("IPC")
+log.setLevel(logging.INFO)
+hdlr = logging.StreamHandler()
+hdlr.setFormatter(logging.Formatter("[%(asctime)s %(name)s/%(levelname)s] %(message)s"))
+log.handlers = [hdlr]
+
+CLIENTS = {}  # name -> websocket
+ROLES = {}  # name -> role
+TOPICS = {}  # topic -> set of subscribed names
+
+
+async def send(name, data):
+    ws = CLIENTS.get(name)
+    if ws is None:
+        return False
+    try:
+        await ws.send(data)
+        return True
+    except websockets.ConnectionClosed:
+        return False
+
 
-CLIENTS = {}
+async def route(source, data):
+    """Forward a frame without decoding its payload"""
+    kind, frame_id, target = Frame.peek(data)
+    if kind == SUBSCRIBE:
+        TOPICS.setdefault(target, set()).add(source)
+    elif kind == EVENT:
+        await asyncio.gather(*[send(name, data) for name in TOPICS.get(target, ()) if name != source])
+    elif kind == REQUEST and target == HUB:
+        await answer(source, Frame.decode(data))
+    elif kind == REQUEST and target == ALL:
+        targets = [name for name, role in ROLES.items() if role == 'cluster']
+        await send(source, Frame(FANOUT, frame_id, HUB, source, {'targets': targets}).encode())
+        await asyncio.gather(*[send(name, data) for name in targets])
+    elif kind in (REQUEST, RESPONSE):
+        if not await send(target, data) and kind == REQUEST:
+            await send(source, Frame(RESPONSE, frame_id, target, source, {'error': 'not connected'}).encode())
+    log.debug(f'{source} -> {target} ({kind}, {len(data)} bytes)')
 
 
-async def dispatch(data):
-    for cluster_name, client in CLIENTS.items():
-        await client.send(data)
-        print(f'> Cluster[{cluster_name}]')
+async def answer(source, frame):
+    command = (frame.payload or {}).get('command')
+    if command == 'clients':
+        payload = {'data': dict(ROLES)}
+    elif command == 'ping':
+        payload = {'data': 'pong'}
+    else:
+        payload = {'error': f'unknown command {command}'}
+    await send(source, Frame(RESPONSE, frame.id, HUB, source, payload).encode())
 
 
-async def serve(ws, path):
-    cluster_name = await ws.recv()
-    cluster_name = cluster_name.decode()
-    if cluster_name in CLIENTS:
-        print(f"! Cluster[{cluster_name}] attempted reconnection")
-        await ws.close(4029, "already connected")
+async def serve(ws, path=None):
+    hello = Frame.decode(await ws.recv())
+    name = hello.source
+    if hello.kind != HELLO or not name or name in (HUB, ALL):
+        await ws.close(4000, "invalid hello")
         return
-    CLIENTS[cluster_name] = ws
+    stale = CLIENTS.get(name)
+    if stale is not None:
+        # usually the old connection of a restarted cluster that was not noticed as closed yet
+        log.warning(f"! {name} reconnected, closing its old connection")
+        for subscribers in TOPICS.values():
+            subscribers.discard(name)
+    CLIENTS[name] = ws
+    ROLES[name] = (hello.payload or {}).get('role', 'cluster')
     try:
-        await ws.send(b'{"status":"ok"}')
-        print(f'$ Cluster[{cluster_name}] connected successfully')
-        async for msg in ws:
-            print(f'< Cluster[{cluster_name}]: {msg}')
-            await dispatch(msg)
+        if stale is not None:
+            # a dead connection can take until the close timeout, do not keep the new one waiting
+            asyncio.get_event_loop().create_task(stale.close(4029, "replaced by a new connection"))
+        await ws.send(Frame(WELCOME, hello.id, HUB, name).encode())
+        log.info(f'$ {name} connected successfully')
+        async for data in ws:
+            try:
+                await route(name, data)
+            except Exception:
+                log.exception(f'Could not route a frame from {name}')
     finally:
-        CLIENTS.pop(cluster_name)
-        print(f'$ Cluster[{cluster_name}] disconnected')
+        # a replaced connection leaves the entries of its successor alone
+        if CLIENTS.get(name) is ws:
+            CLIENTS.pop(name, None)
+            ROLES.pop(name, None)
+            for subscribers in TOPICS.values():
+                subscribers.discard(name)
+        log.info(f'$ {name} disconnected')
 
 
-signal.signal(signal.SIGINT, signal.SIG_DFL)
-signal.signal(signal.SIGTERM, signal.SIG_DFL)
+if __name__ == "__main__":
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if '-v' in sys.argv:
+        log.setLevel(logging.DEBUG)
 
-server = websockets.serve(serve, 'localhost', 42029)
-loop = asyncio.get_event_loop()
-loop.run_until_complete(server)
-loop.run_forever()
+    server = websockets.serve(serve, 'localhost', SETTINGS.ipc_port, max_size=None)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server)
+    loop.run_forever()
@@ -1,14 +1,19 @@
 import asyncio
+import itertools
+import json
 import logging
+import math
 import multiprocessing
 import os
 import signal
 import sys
+import threading
 import time
 
 import requests
 
 from bot import ClusterBot
+from essentials.ipc_protocol import IPCClient, LAUNCHER
 from essentials.multi_server import get_pre
 from essentials.settings import SETTINGS
 
@@ -28,7 +33,18 @@ CLUSTER_NAMES = (
     'India', 'Juliett', 'Kilo', 'Mike', 'November', 'Oscar', 'Papa', 'Quebec',
     'Romeo', 'Sierra', 'Tango', 'Uniform', 'Victor', 'Whisky', 'X-ray', 'Yankee', 'Zulu'
 )
-NAMES = iter(CLUSTER_NAMES)
+
+
+def cluster_names():
+    """Alpha ... Zulu, then Alpha-2 ... Zulu-2 and so on"""
+    for name in CLUSTER_NAMES:
+        yield name
+    for round_nr in itertools.count(2):
+        for name in CLUSTER_NAMES:
+            yield f'{name}-{round_nr}'
+
+
+NAMES = cluster_names()
 
 
 class Launcher:
@@ -43,6 +59,13 @@ class Launcher:
 
         self.keep_alive = None
         self.init = time.perf_counter()
+        self.max_concurrency = 1
+        self.shard_count = 0
+        self.shard_stats = {}  # shard id -> last load report
+        self.stats_dirty = False
+        self.ipc = IPCClient(LAUNCHER, f'ws://localhost:{SETTINGS.ipc_port}', role='launcher')
+        self.ipc.register('status', self.ipc_status)
+        self.ipc_task = None
 
     def get_shard_count(self):
         if SETTINGS.mode == "development":
@@ -54,9 +77,34 @@ class Launcher:
         data.raise_for_status()
         content = data.json()
         log.info(f"Successfully got shard count of {content['shards']} ({data.status_code, data.reason})")
+        limit = content.get('session_start_limit', {})
+        self.max_concurrency = limit.get('max_concurrency', 1)
+        log.info(f"Identify concurrency {self.max_concurrency}, "
+                 f"{limit.get('remaining', '?')}/{limit.get('total', '?')} session starts left")
+        if limit.get('remaining', content['shards']) < content['shards']:
+            log.warning("Not enough session starts left to start all shards")
         # return 2
         return content['shards']
 
+    def plan_boot(self, clusters):
+        """Group clusters into waves that can be started at the same time
+
+        Discord allows one identify per 5 seconds for every rate limit bucket (shard_id % max_concurrency).
+        A cluster identifies its shards one after another, so clusters can start together as long as they
+        share no bucket. With max_concurrency 1 every cluster gets its own wave.
+        """
+        waves = []
+        for cluster in clusters:
+            buckets = {shard_id % self.max_concurrency for shard_id in cluster.shard_ids}
+            for wave, used in waves:
+                if not used & buckets:
+                    wave.append(cluster)
+                    used |= buckets
+                    break
+            else:
+                waves.append(([cluster], set(buckets)))
+        return [wave for wave, _ in waves]
+
     def start(self):
         self.fut = asyncio.ensure_future(self.startup(), loop=self.loop)
 
@@ -80,17 +128,91 @@ class Launcher:
             self.keep_alive.add_done_callback(self.task_complete)
 
     async def startup(self):
-        shards = list(range(self.get_shard_count()))
-        size = [shards[x:x + 4] for x in range(0, len(shards), 4)]
-        log.info(f"Preparing {len(size)} clusters")
-        for shard_ids in size:
-            self.cluster_queue.append(Cluster(self, next(NAMES), shard_ids, len(shards)))
+        # join the IPC bus first, so the status of the clusters can be asked for while they boot
+        self.ipc_task = self.loop.create_task(self.ipc.run())
+        self.shard_count = self.get_shard_count()
+        packing = self.plan_clusters(self.shard_count)
+        log.info(f"Preparing {len(packing)} clusters")
+        for shard_ids in packing:
+            self.cluster_queue.append(Cluster(self, next(NAMES), shard_ids, self.shard_count))
 
         await self.start_cluster()
         self.keep_alive = self.loop.create_task(self.rebooter())
         self.keep_alive.add_done_callback(self.task_complete)
         log.info(f"Startup completed in {time.perf_counter()-self.init}s")
 
+    def plan_clusters(self, shard_count):
+        """Shard ids of every cluster, consecutive shards or packed by recorded load (SETTINGS.cluster_packing)"""
+        shards = list(range(shard_count))
+        cluster_count = SETTINGS.cluster_count or math.ceil(shard_count / SETTINGS.shards_per_cluster)
+        cluster_count = max(1, min(cluster_count, shard_count))
+        if SETTINGS.cluster_packing == 'balanced':
+            loads = self.load_shard_stats(shard_count)
+            if loads is not None:
+                return self.pack_balanced(loads, cluster_count)
+            log.info("No load stats recorded for this shard count, packing consecutive shards")
+        size = math.ceil(shard_count / cluster_count)
+        return [shards[x:x + size] for x in range(0, len(shards), size)]
+
+    def load_shard_stats(self, shard_count):
+        """Relative load of every shard from the last run, None if there are no usable stats"""
+        try:
+            with open(SETTINGS.cluster_stats_file, encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get('shard_count') != shard_count:
+            return None
+        stats = {int(k): v for k, v in saved.get('shards', {}).items()}
+        self.shard_stats = stats
+        if len(stats) != shard_count:
+            return None
+        # guilds and event rate count half each, so shards with busy servers are spread as well
+        total_guilds = sum(s.get('guilds', 0) for s in stats.values()) or 1
+        total_events = sum(s.get('events_per_second', 0) for s in stats.values())
+        loads = {}
+        for shard_id, s in stats.items():
+            load = s.get('guilds', 0) / total_guilds
+            if total_events:
+                load = (load + s.get('events_per_second', 0) / total_events) / 2
+            loads[shard_id] = load
+        return loads
+
+    @staticmethod
+    def pack_balanced(loads, cluster_count):
+        """Greedy packing: the heaviest shard goes to the least loaded cluster that is not full
+
+        Clusters get at most twice the average number of shards, so no cluster ends up with many idle shards.
+        """
+        capacity = 2 * math.ceil(len(loads) / cluster_count)
+        clusters = [(0.0, i, []) for i in range(cluster_count)]
+        for shard_id in sorted(loads, key=loads.get, reverse=True):
+            clusters.sort(key=lambda c: (len(c[2]) >= capacity, c[0], c[1]))
+            load, i, shard_ids = clusters[0]
+            shard_ids.append(shard_id)
+            clusters[0] = (load + loads[shard_id], i, shard_ids)
+        clusters.sort(key=lambda c: c[1])
+        for load, i, shard_ids in clusters:
+            log.info(f"Planned cluster {i}: shards {sorted(shard_ids)}, {load:.1%} of the load")
+        return [sorted(shard_ids) for _, _, shard_ids in clusters if shard_ids]
+
+    def record_stats(self, cluster, stats):
+        for shard_id, shard in stats.items():
+            self.shard_stats[int(shard_id)] = dict(shard, cluster=cluster.name)
+        self.stats_dirty = True
+
+    def save_stats(self):
+        if not self.stats_dirty:
+            return
+        self.stats_dirty = False
+        data = {'shard_count': self.shard_count, 'updated': time.time(),
+                'shards': {str(k): v for k, v in sorted(self.shard_stats.items())}}
+        try:
+            with open(SETTINGS.cluster_stats_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=1)
+        except OSError as e:
+            log.warning(f"Could not save cluster stats: {e}")
+
     async def shutdown(self):
         log.info("Shutting down clusters")
         self.alive = False
@@ -98,6 +220,7 @@ class Launcher:
             self.keep_alive.cancel()
         for cluster in self.clusters:
             cluster.stop()
+        await self.ipc.close()
         self.cleanup()
 
     async def rebooter(self):
@@ -107,29 +230,57 @@ class Launcher:
                 log.warning("All clusters appear to be dead")
                 asyncio.ensure_future(self.shutdown())
             to_remove = []
+            now = time.monotonic()
             for cluster in self.clusters:
+                if cluster.starting:
+                    continue
                 if not cluster.process.is_alive():
                     if cluster.process.exitcode != 0:
                         # ignore safe exits
-                        log.info(f"Cluster#{cluster.name} exited with code {cluster.process.exitcode}")
-                        log.info(f"Restarting cluster#{cluster.name}")
-                        await cluster.start()
+                        if cluster.restart_at is None:
+                            # wait longer after every crash, so a cluster that fails at boot doesn't use up
+                            # the identify quota and the database connections
+                            delay = cluster.backoff()
+                            cluster.restart_at = now + delay
+                            log.info(f"Cluster#{cluster.name} exited with code {cluster.process.exitcode}, "
+                                     f"restarting in {delay}s (crash {cluster.crashes})")
+                        elif now >= cluster.restart_at:
+                            cluster.restart_at = None
+                            log.info(f"Restarting cluster#{cluster.name}")
+                            cluster.start_task = self.loop.create_task(cluster.start())
                     else:
                         log.info(f"Cluster#{cluster.name} found dead")
                         to_remove.append(cluster)
                         cluster.stop()  # ensure stopped
+                elif cluster.is_hung(now):
+                    log.warning(f"Cluster#{cluster.name} sent no heartbeat for "
+                                f"{now - cluster.last_heartbeat:.0f}s, killing it")
+                    cluster.kill()
+                elif cluster.crashes and cluster.ready_at and now - cluster.ready_at > SETTINGS.cluster_stable_after:
+                    cluster.crashes = 0
             for rem in to_remove:
                 self.clusters.remove(rem)
+            self.save_stats()
             await asyncio.sleep(5)
 
+    async def ipc_status(self, data):
+        now = time.monotonic()
+        return {cluster.name: cluster.status(now) for cluster in self.clusters + self.cluster_queue}
+
     async def start_cluster(self):
-        if self.cluster_queue:
-            cluster = self.cluster_queue.pop(0)
-            log.info(f"Starting Cluster#{cluster.name}")
-            await cluster.start()
-            log.info("Done!")
-            self.clusters.append(cluster)
-            await self.start_cluster()
+        # clusters stay in the queue until their wave started, so ipc_status shows them in the meantime
+        waves = self.plan_boot(self.cluster_queue)
+        log.info(f"Starting {sum(len(w) for w in waves)} clusters in {len(waves)} waves "
+                 f"(identify concurrency {self.max_concurrency})")
+        for i, wave in enumerate(waves, 1):
+            log.info(f"Starting wave {i}/{len(waves)}: {', '.join(c.name for c in wave)}")
+            await asyncio.gather(*[cluster.start() for cluster in wave])
+            self.clusters.extend(wave)
+            self.cluster_queue = [c for c in self.cluster_queue if c not in wave]
+        latencies = [c.ready_latency for c in self.clusters if c.ready_latency is not None]
+        if latencies:
+            log.info(f"All clusters launched, ready after {min(latencies):.1f}s to {max(latencies):.1f}s "
+                     f"(mean {sum(latencies) / len(latencies):.1f}s)")
         else:
             log.info("All clusters launched")
 
@@ -149,9 +300,18 @@ class Cluster:
             max_messages=15000,
             shard_ids=shard_ids,
             shard_count=max_shards,
-            cluster_name=name
+            cluster_name=name,
+            cache_config=SETTINGS.cluster_cache_config.get(name, {})
         )
         self.name = name
+        self.shard_ids = shard_ids
+        self.ready_latency = None  # seconds from process start to on_ready of the last start
+        self.ready_at = None
+        self.last_heartbeat = None
+        self.health = {}
+        self.crashes = 0  # crashes since the cluster last ran for SETTINGS.cluster_stable_after
+        self.restart_at = None
+        self.start_task = None
         self.log = logging.getLogger(f"Cluster#{name}")
         self.log.setLevel(logging.DEBUG)
         hdlr = logging.StreamHandler()
@@ -176,15 +336,95 @@ class Cluster:
         kw = self.kwargs
         kw['pipe'] = stdin
         self.process = multiprocessing.Process(target=ClusterBot, kwargs=kw, daemon=True)
+        started = time.perf_counter()
+        self.ready_at = None
+        self.last_heartbeat = None
+        self.health = {}
         self.process.start()
+        # the child has its own copy, closing ours lets recv() see the end of the pipe when the child exits
+        stdin.close()
         self.log.info(f"Process started with PID {self.process.pid}")
 
-        if await self.launcher.loop.run_in_executor(None, stdout.recv) == 1:
-            stdout.close()
-            self.log.info("Process started successfully")
+        # the cluster keeps the pipe open to send load reports, read it in a thread for as long as it lives
+        ready = self.launcher.loop.create_future()
+        threading.Thread(target=self.read_pipe, args=(stdout, ready), daemon=True).start()
+        try:
+            is_ready = await asyncio.wait_for(asyncio.shield(ready), SETTINGS.cluster_ready_timeout)
+        except asyncio.TimeoutError:
+            self.log.warning(f"Not ready after {SETTINGS.cluster_ready_timeout}s, killing the process")
+            self.kill()
+            return False
+        if is_ready:
+            self.ready_at = time.monotonic()
+            self.ready_latency = time.perf_counter() - started
+            self.log.info(f"Process started successfully, ready after {self.ready_latency:.1f}s")
 
         return True
 
+    @property
+    def starting(self):
+        return self.start_task is not None and not self.start_task.done()
+
+    def backoff(self):
+        self.crashes += 1
+        return min(SETTINGS.cluster_restart_backoff * 2 ** (self.crashes - 1), SETTINGS.cluster_restart_backoff_max)
+
+    def is_hung(self, now):
+        if self.ready_at is None:
+            # still connecting, covered by the ready timeout
+            return False
+        return now - (self.last_heartbeat or self.ready_at) > SETTINGS.cluster_heartbeat_timeout
+
+    def status(self, now):
+        if self.process is None:
+            state = 'waiting'
+        elif self.starting or (self.process.is_alive() and self.ready_at is None):
+            state = 'starting'
+        elif not self.process.is_alive():
+            state = f'restarting in {max(self.restart_at - now, 0):.0f}s' if self.restart_at else 'stopped'
+        elif self.is_hung(now):
+            state = 'hung'
+        else:
+            state = 'ready'
+        return dict(
+            self.health,
+            state=state,
+            shard_ids=self.shard_ids,
+            crashes=self.crashes,
+            uptime=now - self.ready_at if self.ready_at else None,
+            heartbeat_age=now - self.last_heartbeat if self.last_heartbeat else None,
+            ready_latency=self.ready_latency,
+        )
+
+    def read_pipe(self, pipe, ready):
+        loop = self.launcher.loop
+        while True:
+            try:
+                message = pipe.recv()
+            except (EOFError, OSError):
+                break
+            loop.call_soon_threadsafe(self.on_pipe_message, message, ready)
+        pipe.close()
+        loop.call_soon_threadsafe(lambda: ready.done() or ready.set_result(False))
+
+    def on_pipe_message(self, message, ready):
+        if message == 1:
+            if not ready.done():
+                ready.set_result(True)
+        elif isinstance(message, dict) and 'stats' in message:
+            self.launcher.record_stats(self, message['stats'])
+        elif isinstance(message, dict) and 'heartbeat' in message:
+            self.last_heartbeat = time.monotonic()
+            self.health = message['heartbeat']
+
+    def kill(self):
+        """Stop a cluster that does not react anymore, the rebooter restarts it"""
+        self.log.info("Killing the process")
+        try:
+            self.process.kill()
+        except (ProcessLookupError, ValueError):
+            pass
+
     def stop(self, sign=signal.SIGINT):
         self.log.info(f"Shutting down with signal {sign!r}")
         try:
@@ -0,0 +1,195 @@
+import asyncio
+import codecs
+import csv
+import io
+import json
+import os
+import struct
+import zlib
+from array import array
+from uuid import uuid4
+
+from essentials.settings import SETTINGS
+
+# export formats besides the text report, format -> file extension
+FORMATS = {
+    'csv': 'csv',
+    'jsonl': 'jsonl',
+    'columnar': 'pmcol',
+}
+
+COLUMNS = ('user_id', 'choice', 'option', 'weight', 'answer', 'timestamp')
+
+# columnar format:
+#   magic, uint32 header length, json header {"columns": [[name, type], ...], ...}
+#   row groups: uint32 number of rows, then per column uint32 length + zlib compressed data
+#   a row group with 0 rows ends the file
+# numeric columns are little endian arrays, "str" columns are uint32 end offsets followed by the utf-8 data
+COLUMNAR_MAGIC = b'PMCOL\x01'
+COLUMNAR_TYPES = (('user_id', 'Q'), ('choice', 'H'), ('weight', 'd'), ('answer', 'str'), ('timestamp', 'q'))
+COLUMNAR_ROW_GROUP = 65536
+
+
+async def iter_vote_rows(bot, poll):
+    """Raw rows (user_id, choice, option, weight, answer, timestamp) of a poll, straight from the cursor
+
+    Anonymous polls have no user ids and timestamps, and the rows of every choice are in random order,
+    like the text report.
+    """
+    projection = {'user_id': 1, 'choice': 1, 'weight': 1, 'answer': 1}
+    options = poll.options_reaction
+    if not poll.anonymous:
+        query = bot.db.votes.find({'poll_id': poll.id}, projection).sort([('user_id', 1), ('choice', 1)])
+        async for v in query:
+            choice = v['choice']
+            yield (int(v['user_id']), choice, options[choice] if choice < len(options) else '',
+                   v.get('weight', 1), v.get('answer', ''), int(v['_id'].generation_time.timestamp()))
+    else:
+        for choice, option in enumerate(options):
+            match = {'poll_id': poll.id, 'choice': choice}
+            size = await bot.db.votes.count_documents(match)
+            if not size:
+                continue
+            pipeline = [{"$match": match}, {"$project": {'_id': 0, 'weight': 1, 'answer': 1}},
+                        {"$sample": {'size': size}}]
+            async for v in bot.db.votes.aggregate(pipeline, allowDiskUse=True):
+                yield None, choice, option, v.get('weight', 1), v.get('answer', ''), None
+
+
+async def csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    async for row in rows:
+        writer.writerow(['' if value is None else value for value in row])
+        if buffer.tell() >= SETTINGS.export_buffer_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+async def jsonl_chunks(rows):
+    lines = []
+    async for row in rows:
+        lines.append(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False))
+        if len(lines) >= 1000:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+async def columnar_chunks(rows, poll):
+    header = json.dumps({
+        'columns': [list(c) for c in COLUMNAR_TYPES],
+        'poll_id': str(poll.id),
+        'server_id': str(poll.server.id),
+        'short': poll.short,
+        'options': poll.options_reaction,
+        'anonymous': poll.anonymous,
+    }).encode('utf-8')
+    yield COLUMNAR_MAGIC + struct.pack('<I', len(header)) + header
+
+    group = []
+    async for row in rows:
+        # the option label is stored once in the header
+        group.append((row[0] or 0, row[1], row[3], row[4] or '', row[5] or 0))
+        if len(group) >= COLUMNAR_ROW_GROUP:
+            yield _row_group(group)
+            group = []
+    if group:
+        yield _row_group(group)
+    yield struct.pack('<I', 0)
+
+
+def _row_group(group):
+    out = [struct.pack('<I', len(group))]
+    for i, (name, kind) in enumerate(COLUMNAR_TYPES):
+        values = [row[i] for row in group]
+        if kind == 'str':
+            data = bytearray()
+            offsets = array('I')
+            for value in values:
+                data += str(value).encode('utf-8')
+                offsets.append(len(data))
+            raw = _little_endian(offsets).tobytes() + bytes(data)
+        else:
+            raw = _little_endian(array(kind, values)).tobytes()
+        block = zlib.compress(raw)
+        out.append(struct.pack('<I', len(block)))
+        out.append(block)
+    return b''.join(out)
+
+
+def _little_endian(values):
+    if struct.pack('=I', 1) != struct.pack('<I', 1):
+        values.byteswap()
+    return values
+
+
+def read_columnar(fp):
+    """Read a columnar export from a binary file object, returns (header, {column: list of values})"""
+    if fp.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError('Not a columnar poll export')
+    header = json.loads(fp.read(struct.unpack('<I', fp.read(4))[0]))
+    columns = {name: [] for name, _ in header['columns']}
+    while True:
+        rows = struct.unpack('<I', fp.read(4))[0]
+        if rows == 0:
+            return header, columns
+        for name, kind in header['columns']:
+            raw = zlib.decompress(fp.read(struct.unpack('<I', fp.read(4))[0]))
+            if kind == 'str':
+                offsets = _little_endian(array('I', raw[:4 * rows]))
+                data = raw[4 * rows:]
+                start = 0
+                for end in offsets:
+                    columns[name].append(data[start:end].decode('utf-8'))
+                    start = end
+            else:
+                columns[name].extend(_little_endian(array(kind, raw)))
+
+
+async def write_export(path, chunks, binary=False):
+    """Write text or bytes chunks to path
+
+    Writes are buffered and run in the default executor, so large exports do not block the event loop.
+    The file is written under a temporary name first, so a concurrent export of the same poll never sends
+    a half written file.
+    """
+    tmp = f'{path}.{uuid4().hex}.tmp'
+    loop = asyncio.get_event_loop()
+    if binary:
+        outfile = await loop.run_in_executor(None, lambda: open(tmp, 'wb'))
+    else:
+        outfile = await loop.run_in_executor(None, lambda: codecs.open(tmp, 'w', 'utf-8'))
+    try:
+        buffer = []
+        buffered = 0
+        async for chunk in chunks:
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= SETTINGS.export_buffer_size:
+                await loop.run_in_executor(None, outfile.write, (b'' if binary else '').join(buffer))
+                buffer = []
+                buffered = 0
+        await loop.run_in_executor(None, outfile.write, (b'' if binary else '').join(buffer))
+    except BaseException:
+        await loop.run_in_executor(None, outfile.close)
+        await loop.run_in_executor(None, os.remove, tmp)
+        raise
+    await loop.run_in_executor(None, outfile.close)
+    await loop.run_in_executor(None, os.replace, tmp, path)
+    return path
+
+
+def vote_table_chunks(poll, fmt):
+    rows = iter_vote_rows(poll.bot, poll)
+    if fmt == 'csv':
+        return csv_chunks(rows)
+    if fmt == 'jsonl':
+        return jsonl_chunks(rows)
+    if fmt == 'columnar':
+        return columnar_chunks(rows, poll)
+    raise ValueError(f'Unknown export format {fmt}')
@@ -1,11 +1,9 @@
 import asyncio
-import codecs
+import copy
 import datetime
 import logging
 import os
-import random
 import re
-import time
 from string import ascii_lowercase
 from uuid import uuid4
 import traceback
@@ -16,24 +14,28 @@ from discord.ui import Button, View, Modal, TextInput, RoleSelect
 import pytz
 import regex
 from bson import ObjectId
-from matplotlib import get_data_path
-from matplotlib.afm import AFM
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
 from pytz import UnknownTimeZoneError
-from unidecode import unidecode
 
 from essentials.exceptions import *
+from essentials.lrucache import LRUCache
 from essentials.multi_server import get_pre
 from essentials.settings import SETTINGS
+from models.export import FORMATS as EXPORT_FORMATS, vote_table_chunks, write_export
 from models.vote import Vote
-from utils.misc import possible_timezones
+from utils.misc import timezone_for_offset
+from utils.textwidth import text_width
 
 logger = logging.getLogger('discord')
 
-# Helvetica is the closest font to Whitney (discord uses Whitney) in afm
-# This is used to estimate text width and adjust the layout of the embeds
-afm_fname = os.path.join(get_data_path(), 'fonts', 'afm', 'phvr8a.afm')
-with open(afm_fname, 'rb') as fh:
-    afm = AFM(fh)
+# marks fields that are missing in a saved document
+MISSING = object()
+
+# rendered embed fields above the score, see Poll.generate_embed_header
+EMBED_HEADER_CACHE = LRUCache(maxsize=2000)
+# set to False once the database turned out to be a standalone server without transactions
+TRANSACTIONS = True
 
 # A-Z Emojis for Discord
 AZ_EMOJIS = [(b'\\U0001f1a'.replace(b'a', bytes(hex(224 + (6 + i))[2:], "utf-8"))).decode("unicode-escape") for i in
@@ -52,6 +54,10 @@ class Poll:
         self.unique_participants = set()
         self.wizard_messages = []
         self.ping_role = ping_role
+        # version and last saved state of the document, used to only write changed fields
+        self.version = 0
+        self._saved = None
+        self.server_id = None  # stored server id, used when the bot is no longer on the server
 
         if not load and ctx:
             if server is None:
@@ -1019,8 +1025,8 @@ class Poll:
         try:
             message = await user.send(embed=embed)
         except discord.Forbidden:
-            config_result = await self.bot.db.config.find_one({'_id': str(self.channel.guild.id)})
-            if config_result and not config_result.get('error_mess') or config_result and config_result.get('error_mess') == 'True':
+            config_result = await self.bot.guild_config.get(self.channel.guild.id)
+            if config_result.error_messages:
                 errormessage = traceback.format_exc(limit=0)
                 embederror = discord.Embed(title='Poll Reaction Error!', color=discord.Color.red())
                 channel = self.bot.get_channel(self.channel.id)
@@ -1122,7 +1128,7 @@ class Poll:
         else:
             prole = self.ping_role
         return {
-            'server_id': str(self.server.id),
+            'server_id': str(self.server.id) if self.server is not None else self.server_id,
             'channel_id': str(cid),
             'author': str(aid),
             'name': self.name,
@@ -1145,17 +1151,53 @@ class Poll:
             'active': self.active,
             'activation': self.activation,
             'activation_tz': self.activation_tz,
-            'votes': self.votes,
             'thumbnail': self.thumbnail,
             'ping_role': str(prole)
         }
 
+    async def export_name(self, user_id):
+        member = await self.bot.member_cache.get(self.server, int(user_id))
+        if member is None:
+            try:
+                member = await self.bot.fetch_user(int(user_id))
+            except:
+                pass
+        if not member:
+            return "<Deleted User>"
+        return member.name
+
+    async def iter_voters(self):
+        """(user_id, [votes]) per voter, read from a cursor ordered by user"""
+        user_id = None
+        votes = []
+        async for vote in Vote.iter_votes_for_poll(self.bot, self.id):
+            if vote.user_id != user_id and votes:
+                yield user_id, votes
+                votes = []
+            user_id = vote.user_id
+            votes.append(vote)
+        if votes:
+            yield user_id, votes
+
+    async def iter_named_voters(self):
+        """(name, [votes]) per voter, the names of a batch of voters are resolved concurrently"""
+        batch = []
+        async for voter in self.iter_voters():
+            batch.append(voter)
+            if len(batch) >= SETTINGS.export_batch_size:
+                names = await asyncio.gather(*[self.export_name(user_id) for user_id, _ in batch])
+                for name, (_, votes) in zip(names, batch):
+                    yield name, votes
+                batch = []
+        if batch:
+            names = await asyncio.gather(*[self.export_name(user_id) for user_id, _ in batch])
+            for name, (_, votes) in zip(names, batch):
+                yield name, votes
+
     async def to_export(self):
-        """Create report and return string"""
-        # load all votes from database
-        await self.load_full_votes()
+        """Create report, yields it in chunks of text"""
         await self.load_vote_counts()
-        await self.load_unique_participants()
+        participants = await Vote.load_number_of_voters_for_poll(self.bot, self.id)
         # build string for weights
         weight_str = 'No weights'
         if self.weights_roles.__len__() > 0:
@@ -1174,168 +1216,105 @@ class Poll:
                 winning_votes = votes
             elif votes == winning_votes:
                 winning_options.append(o)
-        self.name = regex.sub("\n", " >> ", self.name)
+        name = regex.sub("\n", " >> ", self.name)
         deadline_str = await self.get_deadline(string=True)
         if self.ping_role:
-            print("yes send role ping!!")
             try:
                 getprole = self.server.get_role(int(self.ping_role))
             except:
                 getprole = None
-            print("yes send role ping!!v2", getprole)
         else:
-            print("no role ping!!")
             getprole = None
-        export = (f'--------------------------------------------\n'
-                  f'RT POLLMASTER DISCORD EXPORT\n'
-                  f'--------------------------------------------\n'
-                  f'Server name (ID): {self.server.name} ({self.server.id})\n'
-                  f'Owner of the poll: {f"{self.author.name}" if self.author is not None else "<Deleted User>" }\n'
-                  f'Time of creation: {self.time_created.strftime("%d-%b-%Y %H:%M %Z")}\n'
-                  f'--------------------------------------------\n'
-                  f'POLL SETTINGS\n'
-                  f'--------------------------------------------\n'
-                  f'Question / Name: {self.name}\n'
-                  f'Label: {self.short}\n'
-                  f'Anonymous: {"Yes" if self.anonymous else "No"}\n'
-                  f'# Choices: {"Multiple" if self.multiple_choice == 0 else self.multiple_choice}\n'
-                  f'Answer options: {", ".join(self.options_reaction)}\n'
-                  f'Allowed roles: {", ".join(self.roles) if self.roles.__len__() > 0 else "@everyone"}\n'
-                  f'Weights for roles: {weight_str}\n'
-                  f'ping role: {f"{getprole.name}" if getprole else "None"}\n'
-                  f'Deadline: {deadline_str}\n'
-                  f'thumbnail: {self.thumbnail}\n'
-                  f'--------------------------------------------\n'
-                  f'POLL RESULTS\n'
-                  f'--------------------------------------------\n'
-                  f'Number of participants: {len(self.unique_participants)}\n'
-                  f'Raw results: {", ".join([str(o)+": "+str(self.vote_counts.get(i, 0)) for i,o in enumerate(self.options_reaction)])}\n'
-                  f'Weighted results: {", ".join([str(o)+": "+str(self.vote_counts_weighted.get(i, 0)) for i,o in enumerate(self.options_reaction)])}\n'
-                  f'Winning option{"s" if len(winning_options) > 1 else ""}: {", ".join(winning_options)} with {winning_votes} votes\n')
+        yield (f'--------------------------------------------\n'
+               f'RT POLLMASTER DISCORD EXPORT\n'
+               f'--------------------------------------------\n'
+               f'Server name (ID): {self.server.name} ({self.server.id})\n'
+               f'Owner of the poll: {f"{self.author.name}" if self.author is not None else "<Deleted User>" }\n'
+               f'Time of creation: {self.time_created.strftime("%d-%b-%Y %H:%M %Z")}\n'
+               f'--------------------------------------------\n'
+               f'POLL SETTINGS\n'
+               f'--------------------------------------------\n'
+               f'Question / Name: {name}\n'
+               f'Label: {self.short}\n'
+               f'Anonymous: {"Yes" if self.anonymous else "No"}\n'
+               f'# Choices: {"Multiple" if self.multiple_choice == 0 else self.multiple_choice}\n'
+               f'Answer options: {", ".join(self.options_reaction)}\n'
+               f'Allowed roles: {", ".join(self.roles) if self.roles.__len__() > 0 else "@everyone"}\n'
+               f'Weights for roles: {weight_str}\n'
+               f'ping role: {f"{getprole.name}" if getprole else "None"}\n'
+               f'Deadline: {deadline_str}\n'
+               f'thumbnail: {self.thumbnail}\n'
+               f'--------------------------------------------\n'
+               f'POLL RESULTS\n'
+               f'--------------------------------------------\n'
+               f'Number of participants: {participants}\n'
+               f'Raw results: {", ".join([str(o)+": "+str(self.vote_counts.get(i, 0)) for i,o in enumerate(self.options_reaction)])}\n'
+               f'Weighted results: {", ".join([str(o)+": "+str(self.vote_counts_weighted.get(i, 0)) for i,o in enumerate(self.options_reaction)])}\n'
+               f'Winning option{"s" if len(winning_options) > 1 else ""}: {", ".join(winning_options)} with {winning_votes} votes\n')
 
         if not self.anonymous:
-            export += '--------------------------------------------\n' \
-                      'DETAILED POLL RESULTS\n' \
-                      '--------------------------------------------'
-
-            for user_id in self.unique_participants:
-                # member = self.server.get_member(int(user_id))
-                # member = await self.bot.fetch_user(int(user_id))
-                member = await self.bot.member_cache.get(self.server, int(user_id))
-                if member is None:
-                    try:
-                        member = await self.bot.fetch_user(int(user_id))
-                    except:
-                        pass
+            yield '--------------------------------------------\n' \
+                  'DETAILED POLL RESULTS\n' \
+                  '--------------------------------------------'
 
-                if not member:
-                    name = "<Deleted User>"
-                else:
-                    name = member.name
-                if not name:
-                    name = member.name
-
-                export += f'\n{name}: '
-                # if self.votes[str(user_id)]['weight'] != 1:
-                #     export += f' (weight: {self.votes[str(user_id)]["weight"]})'
-                # export += ': ' + ', '.join([self.options_reaction[c] for c in self.votes[str(user_id)]['choices']])
+            async for voter_name, votes in self.iter_named_voters():
                 choice_text_list = []
-
-                for vote in self.full_votes:
-                    if vote.user_id != user_id:
-                        continue
-
+                for vote in votes:
                     choice_text = self.options_reaction[vote.choice]
                     if vote.choice in self.survey_flags:
                         choice_text += f' ({vote.answer}) '
                     choice_text_list.append(choice_text)
+                yield f'\n{voter_name}: ' + ', '.join(choice_text_list)
 
-                # for choice in self.votes[str(user_id)]['choices']:
-                #     choice_text = self.options_reaction[choice]
-                #     if choice in self.survey_flags:
-                #         choice_text += " ("\
-                #                   + self.votes[str(user_id)]["answers"][self.survey_flags.index(choice)] \
-                #                   + ") "
-                #     choice_text_list.append(choice_text)
-
-                if choice_text_list:
-                    export += ', '.join(choice_text_list)
-
-            export += '\n'
+            yield '\n'
         else:
-            export += '--------------------------------------------\n' \
-                      'LIST OF PARTICIPANTS\n' \
-                      '--------------------------------------------'
-
-            for user_id in self.unique_participants:
-                # member = self.server.get_member(int(user_id))
-                # member = await self.bot.fetch_user(int(user_id))
-                member = await self.bot.member_cache.get(self.server, int(user_id))
-                if member is None:
-                    try:
-                        member = await self.bot.fetch_user(int(user_id))
-                    except:
-                        pass
-                if not member:
-                    name = "<Deleted User>"
-                else:
-                    name = member.name
-                if not name:
-                    name = member.name
+            yield '--------------------------------------------\n' \
+                  'LIST OF PARTICIPANTS\n' \
+                  '--------------------------------------------'
 
-                export += f'\n{name}'
-                # if self.votes[str(user_id)]['weight'] != 1:
-                #     export += f' (weight: {self.votes[str(user_id)]["weight"]})'
-                # export += ': ' + ', '.join([self.options_reaction[c] for c in self.votes[str(user_id)]['choices']])
-            export += '\n'
+            async for voter_name, _ in self.iter_named_voters():
+                yield f'\n{voter_name}'
+            yield '\n'
 
             if len(self.survey_flags) > 0:
-                export += '--------------------------------------------\n' \
-                          'CUSTOM ANSWERS (RANDOM ORDER)\n' \
-                          '--------------------------------------------'
+                yield '--------------------------------------------\n' \
+                      'CUSTOM ANSWERS (RANDOM ORDER)\n' \
+                      '--------------------------------------------'
                 for i, o in enumerate(self.options_reaction):
                     if i not in self.survey_flags:
                         continue
-                    custom_answers = []
-
-                    for vote in self.full_votes:
-                        if vote.choice == i and vote.answer != '':
-                            custom_answers.append(f'\n{vote.answer}')
-
-                    # for user_id in self.votes:
-                    #     if i in self.votes[str(user_id)]["choices"]:
-                    #         custom_answers.append(f'\n{self.votes[str(user_id)]["answers"][self.survey_flags.index(i)]}')
-
-                    export += "\n" + o + ":"
-                    if len(custom_answers) > 0:
-                        random.shuffle(custom_answers)  # randomize answers per question
-                        for answer in custom_answers:
-                            export += answer
-                            export += '\n'
-                    else:
-                        export += "\nNo custom answers were submitted."
-                        export += '\n'
-
-        export += ('--------------------------------------------\n'
-                   'BOT DETAILS\n'
-                   '--------------------------------------------\n'
-                   'Creator: RJGamer1002#8253\n'
-                   'Link to invite, vote for or support RT Pollmaster:\n'
-                   'https://top.gg/bot/753217458029985852\n'
-                   '--------------------------------------------\n'
-                   'END OF FILE\n'
-                   '--------------------------------------------\n')
-        return export
-
-    async def export(self):
-        """Create export file and return path"""
+                    yield "\n" + o + ":"
+                    no_answers = True
+                    async for answer in Vote.iter_answers_for_choice(self.bot, self.id, i):
+                        no_answers = False
+                        yield f'\n{answer}\n'
+                    if no_answers:
+                        yield "\nNo custom answers were submitted.\n"
+
+        yield ('--------------------------------------------\n'
+               'BOT DETAILS\n'
+               '--------------------------------------------\n'
+               'Creator: RJGamer1002#8253\n'
+               'Link to invite, vote for or support RT Pollmaster:\n'
+               'https://top.gg/bot/753217458029985852\n'
+               '--------------------------------------------\n'
+               'END OF FILE\n'
+               '--------------------------------------------\n')
+
+    async def export(self, fmt='txt'):
+        """Create export file and return path
+
+        txt is the readable report, the other formats (see models/export.py) contain the raw vote table.
+        Exports are streamed into the file, so large polls are never held in memory.
+        """
         checkexist = os.path.exists('export')
         if not self.open and checkexist == True:
             clean_label = str(self.short).replace("/", "").replace(".", "")
-            fn = 'export/' + str(self.server.id) + '_' + clean_label + '.txt'
-            with codecs.open(fn, 'w', 'utf-8') as outfile:
-                outfile.write(await self.to_export())
-            return fn
+            fn = 'export/' + str(self.server.id) + '_' + clean_label
+            if fmt == 'txt':
+                return await write_export(fn + '.txt', self.to_export())
+            return await write_export(f'{fn}.{EXPORT_FORMATS[fmt]}', vote_table_chunks(self, fmt),
+                                      binary=fmt == 'columnar')
         else:
             return None
 
@@ -1347,12 +1326,13 @@ class Poll:
                 emoji = None
                 if e_id:
                     emoji = self.bot.get_emoji(int(e_id[0]))
-                if not emoji or emoji.guild_id != self.server.id:
+                if not emoji or self.server is None or emoji.guild_id != self.server.id:
                     self.options_reaction_emoji_only = False
                     break
 
     async def from_dict(self, d):
         self.id = ObjectId(str(d['_id']))
+        self.server_id = str(d['server_id'])
         self.server = self.bot.get_guild(int(d['server_id']))
         self.channel = self.bot.get_channel(int(d['channel_id']))
         if self.server is not None:
@@ -1418,7 +1398,8 @@ class Poll:
         self.open = d['open']
 
         self.cursor_pos = 0
-        self.votes = d['votes']
+        # legacy field, votes are stored in their own collection
+        self.votes = d.get('votes', {})
         try:
             #print("from_dict ping_role yes")
             self.ping_role = d['ping_role']
@@ -1432,16 +1413,56 @@ class Poll:
             #print("from_dict thumbnail no")
             self.thumbnail = "default"
 
+        self.version = d.get('version', 0)
+        self._saved = copy.deepcopy(await self.to_dict())
+
         self.open = await self.is_open()
         self.active = await self.is_active()
 
     async def save_to_db(self):
-        await self.bot.db.polls.update_one({'server_id': str(self.server.id), 'short': str(self.short)},
-                                           {'$set': await self.to_dict()}, upsert=True)
+        document = await self.to_dict()
+        if self._saved is None or self.id is None:
+            # new poll, write the whole document
+            result = await self.bot.db.polls.find_one_and_update(
+                {'server_id': document['server_id'], 'short': str(self.short)},
+                {'$set': document, '$inc': {'version': 1}},
+                projection={'version': 1}, upsert=True, return_document=ReturnDocument.AFTER
+            )
+            self.id = result['_id']
+            self.version = result['version']
+            await Vote.create_counts_for_poll(self.bot, self.id)
+        else:
+            changes = {k: v for k, v in document.items() if self._saved.get(k, MISSING) != v}
+            for attempt in range(5):
+                if not changes:
+                    break
+                # only write if nobody else saved the poll since it was loaded (documents without a version are 0)
+                version = self.version if self.version else {'$in': [0, None]}
+                result = await self.bot.db.polls.update_one({'_id': self.id, 'version': version},
+                                                            {'$set': changes, '$inc': {'version': 1}})
+                if result.modified_count:
+                    self.version += 1
+                    break
+                # conflict: keep the other writes and only apply our changes that are still missing
+                current = await self.bot.db.polls.find_one({'_id': self.id})
+                if current is None:
+                    break
+                self.version = current.get('version', 0)
+                changes = {k: v for k, v in changes.items() if current.get(k, MISSING) != v}
+            else:
+                logger.warning(f'Could not save poll {self.short} ({self.id}) after 5 attempts: {changes}')
+        self._saved = copy.deepcopy(document)
+        self.bot.poll_cache.invalidate(document['server_id'], self.short)
+        self.bot.invalidator.poll(document['server_id'], self.short, self.id)
+        self.bot.deadlines.track_poll(self)
 
     @staticmethod
     async def load_from_db(bot, server_id, short, ctx=None, ):
-        query = await bot.db.polls.find_one({'server_id': str(server_id), 'short': short})
+        query = bot.poll_cache.get(server_id, short)
+        if query is None:
+            query = await bot.db.polls.find_one({'server_id': str(server_id), 'short': short})
+            if query is not None:
+                bot.poll_cache.put(query)
         if query is not None:
             p = Poll(bot, ctx, load=True)
             await p.from_dict(query)
@@ -1449,6 +1470,84 @@ class Poll:
         else:
             return None
 
+    @staticmethod
+    async def link_message(bot, message, server_id, short):
+        """Remember which poll was posted in this message, in memory and in the database"""
+        bot.poll_cache.link_message(message.id, server_id, short)
+        await bot.db.poll_messages.update_one(
+            {'_id': str(message.id)},
+            {'$set': {'server_id': str(server_id), 'short': str(short), 'channel_id': str(message.channel.id)}},
+            upsert=True
+        )
+
+    @staticmethod
+    async def resolve_message(bot, message_id):
+        """Find the (server_id, short) of the poll posted in a message without fetching the message.
+        Returns False if the message is known not to be a poll and None if it is unknown."""
+        key = bot.poll_cache.resolve_message(message_id)
+        if key is not None:
+            return key
+        query = await bot.db.poll_messages.find_one({'_id': str(message_id)})
+        if query is None:
+            return None
+        bot.poll_cache.link_message(message_id, query['server_id'], query['short'])
+        return query['server_id'], query['short']
+
+    async def delete_from_db(self, progress=None):
+        """Delete the poll together with its votes, vote counts and message links
+
+        Polls up to SETTINGS.vote_delete_transaction_max votes are deleted in one transaction if the database
+        supports it. Larger polls are deleted without one, progress(deleted, total) is awaited before and
+        after their votes are removed. Returns True if the poll was deleted.
+        """
+        global TRANSACTIONS
+        db = self.bot.db
+        messages_query = {'server_id': str(self.server.id), 'short': str(self.short)}
+        message_ids = [m['_id'] async for m in db.poll_messages.find(messages_query, {'_id': 1})]
+        total = await db.votes.count_documents({'poll_id': self.id})
+
+        deleted = None
+        if total <= SETTINGS.vote_delete_transaction_max and TRANSACTIONS:
+            try:
+                async with await db.client.start_session() as session:
+                    async with session.start_transaction():
+                        deleted = await self._delete_documents(messages_query, session=session)
+            except OperationFailure as e:
+                if e.code != 20:  # IllegalOperation: standalone servers have no transactions
+                    raise
+                TRANSACTIONS = False
+                logger.info('The database does not support transactions, deleting polls without them')
+        if deleted is None:
+            # without a transaction remove the poll first, so left over votes are never visible
+            deleted = await self._delete_documents(messages_query, progress=progress, total=total)
+
+        self.bot.deadlines.untrack_poll(self.id)
+        self.bot.voter_cache.forget(self.id)
+        self.bot.poll_cache.forget(self.server.id, self.short)
+        self.bot.refresh_scheduler.forget(self.id, message_ids)
+        for message_id in message_ids:
+            self.bot.message_cache.pop(int(message_id))
+        self.bot.invalidator.poll_deleted(self.server.id, self.short, self.id, message_ids)
+        logger.info(f'Deleted poll {self.short} ({self.id}) of server {self.server.id} with {total} votes')
+        return deleted
+
+    async def _delete_documents(self, messages_query, session=None, progress=None, total=0):
+        db = self.bot.db
+        result = await db.polls.delete_one({'_id': self.id}, session=session)
+        if session is not None:
+            await db.votes.delete_many({'poll_id': self.id}, session=session)
+        else:
+            # one delete_many, the server removes the votes in index order without sending their ids back
+            report = progress is not None and total > SETTINGS.vote_delete_transaction_max
+            if report:
+                await progress(0, total)
+            deleted_votes = (await db.votes.delete_many({'poll_id': self.id})).deleted_count
+            if report:
+                await progress(deleted_votes, total)
+        await db.poll_counts.delete_one({'_id': self.id}, session=session)
+        await db.poll_messages.delete_many(messages_query, session=session)
+        return result.deleted_count == 1
+
     async def load_votes_for_user(self, user_id):
         return await Vote.load_votes_for_poll_and_user(self.bot, self.id, user_id)
 
@@ -1461,14 +1560,11 @@ class Poll:
 
     async def load_vote_counts(self):
         if not self.vote_counts:
-            self.vote_counts = await Vote.load_vote_counts_for_poll(self.bot, self.id)
+            self.vote_counts, weighted = await Vote.load_vote_totals_for_poll(self.bot, self.id)
+            if len(self.weights_numbers) > 0:
+                self.vote_counts_weighted = weighted
 
-        if len(self.weights_numbers) > 0 and not self.vote_counts_weighted:
-            # find weighted totals
-            await self.load_full_votes()
-            for v in self.full_votes:
-                self.vote_counts_weighted[v.choice] = self.vote_counts_weighted.get(v.choice, 0) + v.weight
-        else:
+        if len(self.weights_numbers) == 0:
             self.vote_counts_weighted = self.vote_counts
 
     async def load_full_votes(self):
@@ -1484,9 +1580,7 @@ class Poll:
         name = str(name)
         value = str(value)
 
-        nwidth = afm.string_width_height(unidecode(name))
-        vwidth = afm.string_width_height(unidecode(value))
-        w = max(nwidth[0], vwidth[0])
+        w = max(text_width(name), text_width(value))
 
         embed.add_field(name=name, value=value, inline=False if w > 12500 and self.cursor_pos % 2 == 1 else True)
         self.cursor_pos += 1
@@ -1499,20 +1593,23 @@ class Poll:
 
         return embed
 
-    async def generate_embed(self):
-        """Generate Discord Report"""
-        self.cursor_pos = 0
-        embed = discord.Embed(title='', colour=SETTINGS.color)  # f'Status: {"Open" if self.is_open() else "Closed"}'
-        embed.set_author(name=f' >> {self.short} ',
-                         icon_url=SETTINGS.author_icon)
-        #embed.set_thumbnail(url=SETTINGS.report_icon)
-        if not self.thumbnail == "default":
-            embed.set_thumbnail(url=self.thumbnail)
-        else:
-            embed.set_thumbnail(url=SETTINGS.report_icon)
+    async def generate_embed_header(self):
+        """Fields above the score as (name, value, inline) and the cursor position after them
+
+        These only change with the poll settings or when the poll is closed or activated, so they are cached.
+        """
+        is_open = await self.is_open()
+        is_active = await self.is_active()
+        key = (self.name, tuple(self.roles), tuple(self.weights_roles), tuple(self.weights_numbers),
+               self.anonymous, self.duration, self.duration_tz, self.activation, self.activation_tz, is_open, is_active)
+        cached = EMBED_HEADER_CACHE.get(key, None)
+        if cached is not None:
+            return cached
 
+        self.cursor_pos = 0
+        embed = discord.Embed()
         # ## adding fields with custom, length sensitive function
-        if not await self.is_active():
+        if not is_active:
             embed = self.add_field_custom(name='**INACTIVE**',
                                                 value=f'This poll is inactive until '
                                                       f'{self.get_activation_date(string=True)}.',
@@ -1534,6 +1631,26 @@ class Poll:
         if self.duration != 0:
             embed = self.add_field_custom(name='**Deadline**', value=await self.get_poll_status(), embed=embed)
 
+        cached = ([(field.name, field.value, field.inline) for field in embed.fields], self.cursor_pos)
+        EMBED_HEADER_CACHE.put(key, cached)
+        return cached
+
+    async def generate_embed(self):
+        """Generate Discord Report"""
+        self.cursor_pos = 0
+        embed = discord.Embed(title='', colour=SETTINGS.color)  # f'Status: {"Open" if self.is_open() else "Closed"}'
+        embed.set_author(name=f' >> {self.short} ',
+                         icon_url=SETTINGS.author_icon)
+        #embed.set_thumbnail(url=SETTINGS.report_icon)
+        if not self.thumbnail == "default":
+            embed.set_thumbnail(url=self.thumbnail)
+        else:
+            embed.set_thumbnail(url=SETTINGS.report_icon)
+
+        fields, self.cursor_pos = await self.generate_embed_header()
+        for name, value, inline in fields:
+            embed.add_field(name=name, value=value, inline=inline)
+
         # embed = self.add_field_custom(name='**Author**', value=self.author.name, embed=embed)
         await self.load_vote_counts()
         if self.options_reaction_default:
@@ -1601,7 +1718,12 @@ class Poll:
         embed.set_footer(text='React with ❔ to get info. It is not a vote option.' + custom_text)
         return embed
 
-    async def post_embed(self, destination):
+    async def post_embed(self, destination, throttle=None):
+        # throttle: coroutine function awaited with the route ('message' or 'reaction') before every request,
+        # used to rate limit announcements
+        if throttle is None:
+            async def throttle(route):
+                pass
         if self.ping_role != "0" and self.open:
             print("yes send role ping!!")
             try:
@@ -1612,6 +1734,7 @@ class Poll:
         else:
             print("no role ping!!")
             getprole = None
+        await throttle('message')
         try:
             try:
                 #msg = await destination.send(embed=await self.generate_embed())
@@ -1625,26 +1748,35 @@ class Poll:
                 print('post_embed error has occurred!')
                 embederror.add_field(name=f'Error type: embed', value='A embed error has occurred. Please report to the Dev!', inline=False )
                 embederror.set_footer(text=f'\nThis message will self-destruct in 1 min.')
+                await throttle('message')
                 await destination.send(embed=embederror, delete_after=60)
             else:
                 print('error = unknown', traceback.format_exc())
+            await throttle('message')
             msg = await destination.send(embed=await self.generate_embed())
+        await self.link_message(self.bot, msg, self.server.id, self.short)
         if self.reaction and await self.is_open() and await self.is_active():
             if self.options_reaction_default:
                 for r in self.options_reaction:
+                    await throttle('reaction')
                     await msg.add_reaction(r)
+                await throttle('reaction')
                 await msg.add_reaction('❔')
                 return msg
             else:
                 for i, r in enumerate(self.options_reaction):
+                    await throttle('reaction')
                     if self.options_reaction_emoji_only:
                         await msg.add_reaction(r)
                     else:
                         await msg.add_reaction(AZ_EMOJIS[i])
+                await throttle('reaction')
                 await msg.add_reaction('❔')
                 return msg
         elif not await self.is_open():
+            await throttle('reaction')
             await msg.add_reaction('❔')
+            await throttle('reaction')
             await msg.add_reaction('📎')
         else:
             return msg
@@ -1657,15 +1789,7 @@ class Poll:
             if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
                 dt = pytz.utc.localize(dt)
             if isinstance(self.duration_tz, float):
-                tz = possible_timezones(self.duration_tz, common_only=True)
-                if not tz:
-                    tz = pytz.timezone('UTC')
-                else:
-                    # choose one valid timezone with the offset
-                    try:
-                        tz = pytz.timezone(tz[0])
-                    except UnknownTimeZoneError:
-                        tz = pytz.UTC
+                tz = timezone_for_offset(self.duration_tz)
             else:
                 try:
                     tz = pytz.timezone(self.duration_tz)
@@ -1682,14 +1806,12 @@ class Poll:
             if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
                 dt = pytz.utc.localize(dt)
             if isinstance(self.activation_tz, float):
-                tz = possible_timezones(self.activation_tz, common_only=True)
-                if not tz:
-                    tz = pytz.timezone('UTC')
-                else:
-                    # choose one valid timezone with the offset
-                    tz = pytz.timezone(tz[0])
+                tz = timezone_for_offset(self.activation_tz)
             else:
-                tz = pytz.timezone(self.activation_tz)
+                try:
+                    tz = pytz.timezone(self.activation_tz)
+                except UnknownTimeZoneError:
+                    tz = pytz.UTC
 
             return dt.astimezone(tz)
 
@@ -1762,16 +1884,17 @@ class Poll:
 
         # unvote for anon and hidden count
         if self.anonymous or self.hide_count and user != None:
-            vote = await Vote.load_from_db(self.bot, self.id, user.id, choice)
-            if vote:
-                await vote.delete_from_db()
+            user_choices = await self.bot.voter_cache.choices(self.id, user.id)
+            if choice in user_choices:
+                self.bot.voter_cache.release(self.id, user.id, choice)
+                await Vote(self.bot, self.id, user.id, choice, user_choices[choice]).delete_from_db()
                 await self.refresh(message)
                 #await self.bot.loop.create_task(user.send(f'Your vote for **{self.options_reaction[choice]}** has been REMOVED.'))
                 try:
                     await user.send(f'Your vote for **{self.options_reaction[choice]}** has been REMOVED.')
                 except discord.Forbidden:
-                    config_result = await self.bot.db.config.find_one({'_id': str(self.channel.guild.id)})
-                    if config_result and not config_result.get('error_mess') or config_result and config_result.get('error_mess') == 'True':
+                    config_result = await self.bot.guild_config.get(self.channel.guild.id)
+                    if config_result.error_messages:
                         errormessage = traceback.format_exc(limit=0)
                         embederror = discord.Embed(title='Poll Reaction Error!', color=discord.Color.red())
                         channel = self.bot.get_channel(message.channel.id)
@@ -1786,23 +1909,22 @@ class Poll:
                 return
 
         # check if already voted for the same choice
-        votes = await self.load_votes_for_user(user.id)
-        for v in votes:
-            if v.choice == choice:
-                return  # already voted
+        user_choices = await self.bot.voter_cache.choices(self.id, user.id)
+        if choice in user_choices:
+            return  # already voted
 
         # check if max votes exceeded
-        if 0 < self.multiple_choice <= len(votes):
+        if 0 < self.multiple_choice <= len(user_choices):
             say_text = f'You have reached the **maximum choices of {self.multiple_choice}** for this poll. ' \
                 f'Before you can vote again, you need to unvote one of your choices.\n' \
                 f'Your current choices are:\n'
-            for v in votes:
+            for c in sorted(user_choices):
                 if self.options_reaction_default:
-                    say_text += f'{self.options_reaction[v.choice]}\n'
+                    say_text += f'{self.options_reaction[c]}\n'
                 else:
                     if not self.options_reaction_emoji_only:
-                        say_text += f'{AZ_EMOJIS[v.choice]} '
-                    say_text += f'{self.options_reaction[v.choice]}\n'
+                        say_text += f'{AZ_EMOJIS[c]} '
+                    say_text += f'{self.options_reaction[c]}\n'
             embed = discord.Embed(title='', description=say_text, colour=SETTINGS.color)
             embed.set_author(name='RT Pollmaster', icon_url=SETTINGS.author_icon)
             #self.bot.loop.create_task(user.send(embed=embed))
@@ -1811,8 +1933,8 @@ class Poll:
             try:
                 await user.send(embed=embed)
             except discord.Forbidden:
-                config_result = await self.bot.db.config.find_one({'_id': str(self.channel.guild.id)})
-                if config_result and not config_result.get('error_mess') or config_result and config_result.get('error_mess') == 'True':
+                config_result = await self.bot.guild_config.get(self.channel.guild.id)
+                if config_result.error_messages:
                     errormessage = traceback.format_exc(limit=0)
                     embederror = discord.Embed(title='Poll Reaction Error!', color=discord.Color.red())
                     channel = self.bot.get_channel(message.channel.id)
@@ -1826,40 +1948,47 @@ class Poll:
                     pass
             return
 
-        answer = ''
-        if choice in self.survey_flags:
-            answer = await self.ask_for_input_dm(
-                user,
-                "Custom Answer",
-                "For this vote option you can provide a custom reply. "
-                "Note that everyone will be able to see the answer. If you don't want to provide a "
-                "custom answer, type \"-\""
-            )
-            if not answer or answer.lower() == "-":
-                answer = "No Answer"
+        # reserve the choice, reactions that arrive while this vote is processed already see it
+        self.bot.voter_cache.reserve(self.id, user.id, choice, weight)
+        try:
+            answer = ''
+            if choice in self.survey_flags:
+                answer = await self.ask_for_input_dm(
+                    user,
+                    "Custom Answer",
+                    "For this vote option you can provide a custom reply. "
+                    "Note that everyone will be able to see the answer. If you don't want to provide a "
+                    "custom answer, type \"-\""
+                )
+                if not answer or answer.lower() == "-":
+                    answer = "No Answer"
 
-        if self.anonymous or self.hide_count:
-            #self.bot.loop.create_task(user.send(f'Your vote for **{self.options_reaction[choice]}** has been counted.'))
-            try:
-                await user.send(f'Your vote for **{self.options_reaction[choice]}** has been counted.')
-            except discord.Forbidden:
-                config_result = await self.bot.db.config.find_one({'_id': str(self.channel.guild.id)})
-                if config_result and not config_result.get('error_mess') or config_result and config_result.get('error_mess') == 'True':
-                    errormessage = traceback.format_exc(limit=0)
-                    embederror = discord.Embed(title='Poll Reaction Error!', color=discord.Color.red())
-                    channel = self.bot.get_channel(message.channel.id)
-                    if errormessage.find("Cannot send messages to this user") >= 0:
-                        embederror.add_field(name=f'Error type:', value='Error: can\'t send you a DM. please allow DM for this bot!\nYour vote was most likely still counted', inline=False )
-                        embederror.set_footer(text=f'From poll: {self.short} \nThis message will self-destruct in 1 min.')
-                        await channel.send(f"<@{user.id}> Error!", embed=embederror, delete_after=60)
+            if self.anonymous or self.hide_count:
+                #self.bot.loop.create_task(user.send(f'Your vote for **{self.options_reaction[choice]}** has been counted.'))
+                try:
+                    await user.send(f'Your vote for **{self.options_reaction[choice]}** has been counted.')
+                except discord.Forbidden:
+                    config_result = await self.bot.guild_config.get(self.channel.guild.id)
+                    if config_result.error_messages:
+                        errormessage = traceback.format_exc(limit=0)
+                        embederror = discord.Embed(title='Poll Reaction Error!', color=discord.Color.red())
+                        channel = self.bot.get_channel(message.channel.id)
+                        if errormessage.find("Cannot send messages to this user") >= 0:
+                            embederror.add_field(name=f'Error type:', value='Error: can\'t send you a DM. please allow DM for this bot!\nYour vote was most likely still counted', inline=False )
+                            embederror.set_footer(text=f'From poll: {self.short} \nThis message will self-destruct in 1 min.')
+                            await channel.send(f"<@{user.id}> Error!", embed=embederror, delete_after=60)
+                        else:
+                            print('error = unknown', traceback.format_exc())
                     else:
-                        print('error = unknown', traceback.format_exc())
-                else:
-                    pass
+                        pass
 
-        # commit
-        vote = Vote(self.bot, self.id, user.id, choice, weight, answer)
-        await vote.save_to_db()
+            # commit
+            vote = Vote(self.bot, self.id, user.id, choice, weight, answer)
+            await vote.save_to_db()
+        except Exception:
+            self.bot.voter_cache.release(self.id, user.id, choice)
+            raise
+        self.bot.user_guilds.add(user.id, self.server.id)
         if not self.hide_count:
             await self.refresh(message)
 
@@ -1888,9 +2017,10 @@ class Poll:
         if choice == 'invalid':
             return
 
-        vote = await Vote.load_from_db(self.bot, self.id, user.id, choice)
-        if vote:
-            await vote.delete_from_db()
+        user_choices = await self.bot.voter_cache.choices(self.id, user.id)
+        if choice in user_choices:
+            self.bot.voter_cache.release(self.id, user.id, choice)
+            await Vote(self.bot, self.id, user.id, choice, user_choices[choice]).delete_from_db()
 
         if not self.hide_count:
             await self.refresh(message)
@@ -1904,15 +2034,14 @@ class Poll:
             return False
 
     async def refresh(self, message, await_=False, force=False):
-        # dont refresh if there was a refresh in the past 5 seconds
-        if not force and self.bot.refresh_blocked.get(str(self.id), 0)-time.time() > 0:
-            self.bot.refresh_queue[str(self.id)] = message
+        # edits are coalesced by the refresh scheduler, force skips the wait (e.g. to show a closed poll)
+        edit = self.bot.refresh_scheduler.request(self, message, force=force)
+        if edit is None:
             return
-        self.bot.refresh_blocked[str(self.id)] = time.time() + 5
         if await_:
-            await message.edit(embed=await self.generate_embed())
+            await edit
         else:
-            self.bot.loop.create_task(message.edit(embed=await self.generate_embed()))
+            self.bot.loop.create_task(edit)
 
     class namebuttons(View):
         def __init__(self, ctx):
@@ -1,5 +1,9 @@
+import logging
+
 from bson import ObjectId
 
+logger = logging.getLogger('discord')
+
 
 class Vote:
     def __init__(
@@ -41,17 +45,80 @@ class Vote:
         else:
             return None
 
+    @staticmethod
+    async def iter_votes_for_poll(bot, poll_id: ObjectId):
+        """Votes of a poll ordered by user, read from a cursor instead of loading the whole poll"""
+        query = bot.db.votes.find({'poll_id': poll_id}).sort([('user_id', 1), ('choice', 1)])
+        async for v in query:
+            yield Vote(bot, poll_id, v['user_id'], v['choice'], v['weight'], v['answer'], v['_id'])
+
+    @staticmethod
+    async def iter_answers_for_choice(bot, poll_id: ObjectId, choice: int):
+        """Custom answers given for a choice, in random order"""
+        match = {'poll_id': poll_id, 'choice': choice, 'answer': {'$nin': ['', None]}}
+        size = await bot.db.votes.count_documents(match)
+        if not size:
+            return
+        pipeline = [
+            {"$match": match},
+            {"$project": {'_id': 0, 'answer': 1}},
+            {"$sample": {'size': size}}
+        ]
+        async for v in bot.db.votes.aggregate(pipeline, allowDiskUse=True):
+            yield v['answer']
+
     @staticmethod
     async def load_vote_counts_for_poll(bot, poll_id: ObjectId,):
+        counts, _ = await Vote.load_vote_totals_for_poll(bot, poll_id)
+        return counts
+
+    @staticmethod
+    async def load_vote_totals_for_poll(bot, poll_id: ObjectId):
+        """Raw and weighted vote counts per choice, read from the poll_counts collection
+
+        The counters are created with the poll and kept up to date by the vote writer (essentials/votequeue.py).
+        Counters that are missing or were not built from the votes (polls from before they existed) are
+        aggregated from the votes first.
+        """
+        query = await bot.db.poll_counts.find_one({'_id': poll_id})
+        if query is None or not query.get('built'):
+            query = await Vote.rebuild_counts_for_poll(bot, poll_id)
+        counts = {int(c): n for c, n in query.get('raw', {}).items() if n}
+        weighted = {int(c): n for c, n in query.get('weighted', {}).items() if int(c) in counts}
+        return counts, weighted
+
+    @staticmethod
+    async def create_counts_for_poll(bot, poll_id: ObjectId):
+        """Counters of a new poll, it has no votes yet so they are complete from the start"""
+        await bot.db.poll_counts.update_one(
+            {'_id': poll_id},
+            {'$setOnInsert': {'raw': {}, 'weighted': {}, 'built': True}},
+            upsert=True
+        )
+
+    @staticmethod
+    async def rebuild_counts_for_poll(bot, poll_id: ObjectId, attempts=3):
+        """Aggregate the counters from the votes and overwrite the stored ones
+
+        Votes written between the aggregation and the $set would be lost, so the result is checked against
+        the number of votes afterwards and aggregated again if they differ.
+        """
         pipeline = [
             {"$match": {'poll_id': poll_id}},
-            {"$group": {"_id": "$choice", "count": {"$sum": 1}}}
+            {"$group": {"_id": "$choice", "count": {"$sum": 1}, "weight": {"$sum": "$weight"}}}
         ]
-        query = bot.db.votes.aggregate(pipeline)
-        result = {}
-        async for q in query:
-            result[q['_id']] = q['count']
-        return result
+        for attempt in range(attempts):
+            document = {'raw': {}, 'weighted': {}, 'built': True}
+            async for q in bot.db.votes.aggregate(pipeline):
+                document['raw'][str(q['_id'])] = q['count']
+                document['weighted'][str(q['_id'])] = q['weight']
+            await bot.db.poll_counts.update_one({'_id': poll_id}, {'$set': document}, upsert=True)
+            if await bot.db.votes.count_documents({'poll_id': poll_id}) == sum(document['raw'].values()):
+                break
+        else:
+            logger.warning(f'Vote counts of poll {poll_id} changed during {attempts} rebuilds')
+        document['_id'] = poll_id
+        return document
 
     @staticmethod
     async def load_votes_for_poll_and_user(bot, poll_id: ObjectId, user_id):
@@ -66,11 +133,15 @@ class Vote:
 
     @staticmethod
     async def load_number_of_voters_for_poll(bot, poll_id: ObjectId):
-        query = await bot.db.votes.distinct('user_id', {'poll_id': poll_id})
-        if query:
-            return len(query)
-        else:
-            return 0
+        # counted on the server, distinct would return every user id of the poll
+        pipeline = [
+            {"$match": {'poll_id': poll_id}},
+            {"$group": {"_id": "$user_id"}},
+            {"$count": "voters"}
+        ]
+        async for q in bot.db.votes.aggregate(pipeline, allowDiskUse=True):
+            return q['voters']
+        return 0
 
     def to_dict(self):
         return ({
@@ -82,14 +153,9 @@ class Vote:
         })
 
     async def save_to_db(self):
-        await self.bot.db.votes.update_one(
-            {'poll_id': self.poll_id, 'user_id': str(self.user_id), 'choice': self.choice},
-            {'$set': self.to_dict()},
-            upsert=True
-        )
+        """Insert the vote, True if it was new. Writes are batched by bot.vote_writer"""
+        return await self.bot.vote_writer.save(self)
 
     async def delete_from_db(self):
-        if self._id:
-            self.bot.db.votes.delete_one({'_id': self._id})
-
-
+        """Delete the vote, True if it existed. Writes are batched by bot.vote_writer"""
+        return await self.bot.vote_writer.delete(self)
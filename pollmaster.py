@@ -9,14 +9,23 @@ import logging
 import pytz
 
 
+from essentials.deadlines import DeadlineScheduler
+from essentials.guildconfig import GuildConfigCache
+from essentials.invalidation import Invalidator
 from essentials.messagecache import MessageCache
 from essentials.membercache import MemberCache
+from essentials.pollcache import PollCache
+from essentials.refreshscheduler import RefreshScheduler
 from discord.ext import commands, tasks
 from discord import app_commands
 from motor.motor_asyncio import AsyncIOMotorClient
 
-from essentials.multi_server import get_pre
+from essentials.db_indexes import ensure_indexes
+from essentials.multi_server import get_pre, load_prefixes
 from essentials.settings import SETTINGS
+from essentials.userguilds import UserGuildIndex
+from essentials.votequeue import VoteWriter
+from essentials.voterstate import VoterStateCache
 
 syncOnce = False
 
@@ -40,8 +49,15 @@ bot.remove_command('help')
 
 bot.message_cache = MessageCache(bot)
 bot.member_cache = MemberCache()
-bot.refresh_blocked = {}
-bot.refresh_queue = {}
+bot.poll_cache = PollCache()
+bot.refresh_scheduler = RefreshScheduler(bot)
+bot.deadlines = DeadlineScheduler(bot)
+bot.vote_writer = VoteWriter(bot)
+bot.voter_cache = VoterStateCache(bot)
+bot.guild_config = GuildConfigCache(bot)
+bot.user_guilds = UserGuildIndex(bot)
+bot.invalidator = Invalidator(bot)
+bot.pre = {}
 
 # logger
 # create logger with 'spam_application'
@@ -69,6 +85,9 @@ async def setup(bot):
 
 @bot.event
 async def on_message(message):
+    if message.guild is not None and not message.author.bot:
+        # remember where users are active, DM commands offer these guilds
+        bot.user_guilds.add(message.author.id, message.guild.id)
     # allow case insensitive prefix
     prefix = await get_pre(bot, message)
     if type(prefix) == tuple:
@@ -115,14 +134,19 @@ async def on_ready():
     # except:
     #     print("Problem verifying servers.")
 
-    # cache prefixes
-    bot.pre = {entry['_id']: entry.get('prefix', 'pm!') async for entry in bot.db.config.find({}, {'_id', 'prefix'})}
+    # cache prefixes (shards that were ready before are loaded already, see on_shard_ready)
+    await load_prefixes(bot, bot.guilds)
 
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name="/help"))
 
     print("Bot running.")
 
 
+@bot.event
+async def on_shard_ready(shard_id):
+    await load_prefixes(bot, [g for g in bot.guilds if g.shard_id == shard_id])
+
+
 @bot.event
 async def on_command_error(ctx, e):
 
@@ -222,43 +246,43 @@ async def on_error(e, ctx):
 
 @bot.event
 async def on_guild_join(server):
-    result = await bot.db.config.find_one({'_id': str(server.id)})
+    result = await bot.guild_config.get(server.id)
     serverowner = str(server.owner_id)
     print('bot join server:', server.id)
     logger.info(f'bot join server: {server.id}')
-    if result is None:
-        await bot.db.config.update_one(
-            {'_id': str(server.id)},
-            {'$set': {'prefix': 'pm!', 'admin_role': 'polladmin', 'user_role': 'polluser', 'in_guild': 'True', 'ownerid': serverowner, 'timeleave': 'None', 'error_mess': 'True', 'closedpoll_mess': 'True'}},
-            upsert=True
+    if not result:
+        await bot.guild_config.update(
+            server.id,
+            {'prefix': 'pm!', 'admin_role': 'polladmin', 'user_role': 'polluser', 'in_guild': 'True', 'ownerid': serverowner, 'timeleave': 'None', 'error_mess': 'True', 'closedpoll_mess': 'True'}
         )
         bot.pre[str(server.id)] = 'pm!'
     elif result:
-        await bot.db.config.update_one(
-            {'_id': str(server.id)},
-            {'$set': {'in_guild': 'True', 'ownerid': serverowner, 'timeleave': 'None'}},
-            upsert=True
+        await bot.guild_config.update(
+            server.id,
+            {'in_guild': 'True', 'ownerid': serverowner, 'timeleave': 'None'}
         )
         bot.pre[str(server.id)] = 'pm!'
 
 @bot.event
 async def on_guild_remove(server):
-    result = await bot.db.config.find_one({'_id': str(server.id)})
+    result = await bot.guild_config.get(server.id)
     timeleft = dt.datetime.utcnow().replace(tzinfo=pytz.utc)
     print('bot was removed from server:', server.id, 'name:', server.name)
     logger.info(f'bot was removed from server: {server.id} name: {server.name}')
     if result:
-        await bot.db.config.update_one(
-            {'_id': str(server.id)},
-            {'$set': {'in_guild': 'False', 'timeleave': timeleft}},
-            upsert=True
+        await bot.guild_config.update(
+            server.id,
+            {'in_guild': 'False', 'timeleave': timeleft}
         )
         #bot.pre[str(server.id)] = 'pm!'
+    # the guild will not be used anymore by this process
+    bot.guild_config.forget(server.id)
 
 async def main():
     async with bot:
         mongo = AsyncIOMotorClient(SETTINGS.mongo_db)
         bot.db = mongo.pollmaster
+        await ensure_indexes(bot.db)
         bot.session = aiohttp.ClientSession()
         await setup(bot)
         await bot.start(SETTINGS.bot_token)
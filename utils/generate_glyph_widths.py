@@ -0,0 +1,44 @@
+"""Generates utils/glyph-widths.json from an Adobe font metrics file
+
+Helvetica (phvr8a.afm, shipped with matplotlib in mpl-data/fonts/afm) is the closest afm font to the font
+discord uses. Only needs to be run again if the font changes:
+
+    python utils/generate_glyph_widths.py path/to/phvr8a.afm
+"""
+import json
+import os
+import sys
+
+
+def parse_afm(path):
+    widths = {}
+    names = {}
+    kerning = {}
+    with open(path, 'r', encoding='latin-1') as fh:
+        for line in fh:
+            if line.startswith('C '):
+                fields = dict(f.strip().split(' ', 1) for f in line.split(';') if f.strip())
+                code = int(fields['C'])
+                # unencoded glyphs (code -1) can not be reached by a character
+                if code < 0:
+                    continue
+                widths[chr(code)] = int(float(fields['WX']))
+                names[fields['N']] = chr(code)
+            elif line.startswith('KPX '):
+                _, left, right, value = line.split()
+                kerning[(left, right)] = int(float(value))
+
+    pairs = {}
+    for (left, right), value in kerning.items():
+        if left in names and right in names:
+            pairs.setdefault(names[left], {})[names[right]] = value
+    return {'widths': widths, 'kerning': pairs}
+
+
+if __name__ == '__main__':
+    table = parse_afm(sys.argv[1])
+    target = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'glyph-widths.json')
+    with open(target, 'w', encoding='utf-8') as out:
+        json.dump(table, out, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+    print(f'{len(table["widths"])} glyphs and {sum(len(k) for k in table["kerning"].values())} kerning pairs '
+          f'written to {target}')
@@ -1,4 +1,5 @@
 import argparse
+import functools
 
 import pytz
 import datetime as dt
@@ -30,24 +31,41 @@ class CustomFormatter(argparse.RawTextHelpFormatter):
             return ', '.join(parts)
 
 
-def possible_timezones(tz_offset, common_only=True):
-    # pick one of the timezone collections
-    timezones = pytz.common_timezones if common_only else pytz.all_timezones
-
+def _offset_delta(tz_offset):
     # convert the float hours offset to a timedelta
     offset_days, offset_seconds = 0, int(tz_offset * 3600)
     if offset_seconds < 0:
         offset_days = -1
         offset_seconds += 24 * 3600
-    desired_delta = dt.timedelta(offset_days, offset_seconds)
+    return dt.timedelta(offset_days, offset_seconds)
+
+
+@functools.lru_cache(maxsize=2)
+def _offset_index(common_only=True):
+    """Maps the non-DST offset of every timezone to the zone names, built once per timezone collection"""
+    # pick one of the timezone collections
+    timezones = pytz.common_timezones if common_only else pytz.all_timezones
 
-    # Loop through the timezones and find any with matching offsets
     null_delta = dt.timedelta(0, 0)
-    results = []
+    index = {}
     for tz_name in timezones:
         tz = pytz.timezone(tz_name)
         non_dst_offset = getattr(tz, '_transition_info', [[null_delta]])[-1]
-        if desired_delta == non_dst_offset[0]:
-            results.append(tz_name)
+        index.setdefault(non_dst_offset[0], []).append(tz_name)
+    return index
+
+
+def possible_timezones(tz_offset, common_only=True):
+    return list(_offset_index(common_only).get(_offset_delta(tz_offset), []))
+
 
-    return results
\ No newline at end of file
+@functools.lru_cache(maxsize=None)
+def timezone_for_offset(tz_offset):
+    """One valid timezone with the offset, UTC if there is none"""
+    tz = possible_timezones(tz_offset, common_only=True)
+    if not tz:
+        return pytz.timezone('UTC')
+    try:
+        return pytz.timezone(tz[0])
+    except pytz.UnknownTimeZoneError:
+        return pytz.UTC
@@ -0,0 +1,36 @@
+import functools
+import json
+import os
+
+from unidecode import unidecode
+
+# Helvetica is the closest font to Whitney (discord uses Whitney) in afm
+# This is used to estimate text width and adjust the layout of the embeds
+# The table is generated from phvr8a.afm by utils/generate_glyph_widths.py
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'glyph-widths.json'), encoding='utf-8') as fh:
+    _table = json.load(fh)
+_WIDTHS = _table['widths']
+_KERNING = _table['kerning']
+# characters without a glyph are counted as a space
+_DEFAULT_WIDTH = _WIDTHS[' ']
+
+
+@functools.lru_cache(maxsize=4096)
+def string_width(s):
+    """Width of a string in font units including kerning, same as matplotlib's AFM.string_width_height"""
+    total = 0
+    last = None
+    for c in s:
+        if c == '\n':
+            continue
+        total += _WIDTHS.get(c, _DEFAULT_WIDTH)
+        if last is not None:
+            total += _KERNING.get(last, {}).get(c, 0)
+        last = c
+    return total
+
+
+@functools.lru_cache(maxsize=4096)
+def text_width(text):
+    """Estimated width of any text, non ascii characters are transliterated first"""
+    return string_width(unidecode(text))